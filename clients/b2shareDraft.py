@@ -7,19 +7,133 @@
 """
 
 #B2SHARE imports
-import requests
+from httpSession import getSession, publicUrl
+from multiprocessing.pool import ThreadPool
+import base64
+import functools
+import hashlib
 import json
 import os
+import time
+import urllib
+
+import requests
+
+UPLOADWORKERS = 4 # files uploaded concurrently
+UPLOADRETRIES = 3 # attempts per file
+PATCHCHUNK    = 1 # operations per request if the server rejects the complete patch
+POLLINTERVAL  = 1 # seconds before the first DOI poll, doubled after each poll
+POLLTIMEOUT   = 600 # seconds to wait for the DOI
+READSIZE      = 4 * 1024 * 1024 # bytes per read when checking an uploaded file
+
+class hashingReader():
+    '''
+    Read-only file wrapper which computes md5 and sha256 checksums of the data that is read
+    and reports the progress as progress(name, bytes read, size).
+    '''
+
+    def __init__(self, stream, name, size, progress = None):
+        self.stream   = stream
+        self.name     = name
+        self.len      = size # requests takes the Content-Length from len
+        self.progress = progress
+        self.seek(0)
+
+    def read(self, size = -1):
+        data = self.stream.read(size)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.done += len(data)
+        if self.progress:
+            self.progress(self.name, self.done, self.len)
+        return data
+
+    def tell(self):
+        return self.done
+
+    def seek(self, offset, whence = 0):
+        #only rewinding is supported, used when a request is retried
+        assert offset == 0 and whence == 0
+        if hasattr(self, 'done'):
+            self.stream.seek(0)
+        self.md5    = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.done   = 0
+
+class b2sharePublication():
+    '''
+    Handle of a draft submitted for publication.
+    B2SHARE mints the DOI asynchronously, poll() checks the record with exponential
+    backoff until the DOI is there or the timeout is reached.
+    '''
+
+    def __init__(self, draft, error = None, timeout = POLLTIMEOUT, interval = POLLINTERVAL):
+        self.draft     = draft
+        self.recordUrl = draft.apiUrl + 'records/' + draft.draftId
+        self.doi       = None
+        self.error     = error
+        self.interval  = interval
+        self.nextPoll  = time.time() + interval
+        self.deadline  = time.time() + timeout
+
+    def done(self):
+        return self.doi is not None or self.error is not None
+
+    def poll(self):
+        '''
+        Checks the record if the next poll is due, does not block.
+        Failed requests count as 'no DOI yet', the last failure is reported at the deadline.
+        Returns True if the handle is done (DOI found or error).
+        '''
+        if self.done() or time.time() < self.nextPoll:
+            return self.done()
+
+        try:
+            response = self.draft.session.get(self.recordUrl, params = {'access_token': self.draft.apiToken})
+            status = str(response.status_code)
+            if response.status_code in range(200, 300):
+                self.doi = response.json().get('metadata', {}).get('DOI')
+        except (requests.RequestException, ValueError) as e:
+            status = repr(e)
+        now = time.time()
+        if self.doi is None and now >= self.deadline:
+            self.error = 'B2SHARE PUBLISH ERROR: No DOI for ' + self.recordUrl + ' ' + status
+        #the last poll is at the deadline
+        self.interval *= 2
+        self.nextPoll = min(now + self.interval, self.deadline)
+
+        return self.done()
+
+    def wait(self):
+        '''
+        Blocks until the handle is done, returns the DOI or None.
+        '''
+        waitAll([self])
+        return self.doi
+
+def waitAll(publications):
+    '''
+    Polls many b2sharePublication handles from one thread until all are done.
+    '''
+    while not all([p.poll() for p in publications]):
+        nextPoll = min([p.nextPoll for p in publications if not p.done()])
+        time.sleep(max(0, nextPoll - time.time()))
 
 class b2shareDraft():
 
-    def __init__(self, apiToken, apiUrl, communityId, draftUrl = ''):
+    def __init__(self, apiToken, apiUrl, communityId, draftUrl = '', session = None):
+        '''
+        session - requests.Session, by default all B2SHARE drafts share one pooled session
+                  with keep-alive and retries (see httpSession.getSession).
+        '''
         self.apiToken   = apiToken
         self.apiUrl     = apiUrl
         self.community  = communityId
         self.draftUrl   = draftUrl
         self.repoName   = 'B2SHARE'
         self.metaKeys   = ['CREATOR', 'TITLE', 'SERIESINFORMATION', 'OTHER']
+        self.session    = session if session is not None else getSession(self.repoName)
+        self.patch      = [] # staged json-patch operations, sent by commit()
 
     def create(self, title):
         '''
@@ -35,7 +149,7 @@ class b2shareDraft():
         data = '{"titles":[{"title":"'+title+'"}], "community":"' + self.community + \
             '", "open_access":true, "community_specific": {}}'
         headers = {"Content-Type":"application/json"}
-        request = requests.post(url = createUrl, params = {'access_token': self.apiToken}, 
+        request = self.session.post(url = createUrl, params = {'access_token': self.apiToken}, 
 		headers=headers, data = data )
 
         if request.status_code not in range(200, 300):
@@ -44,114 +158,248 @@ class b2shareDraft():
         self.draftUrl = self.apiUrl + "records/" + request.json()['id'] + "/draft?access_token=" + self.apiToken
         self.draftId = request.json()['id']
 
-    def patchGeneral(self, metadata):
+    def attach(self, draftUrl):
+        '''
+        Continue working on an existing draft, draftUrl may be given without access token
+        (see httpSession.publicUrl).
+        '''
+        self.draftId = draftUrl.split('records/')[1].split('/')[0]
+        self.draftUrl = self.apiUrl + "records/" + self.draftId + "/draft?access_token=" + self.apiToken
+
+    def publishAsync(self, timeout = POLLTIMEOUT):
+        '''
+        Submits the draft for publication, staged patches are sent in the same request.
+        Does not wait for the DOI, returns a b2sharePublication handle.
+        '''
+        self.patch.append({'op': 'add', 'path': '/publication_state', 'value': 'submitted'})
+        errorMsg = self.commit()
+        if not hasattr(self, 'draftId'):
+            self.attach(self.draftUrl)
+
+        return b2sharePublication(self, error = '; '.join(errorMsg) or None, timeout = timeout)
+
+    def publication(self, timeout = POLLTIMEOUT):
+        '''
+        Returns a b2sharePublication handle for a draft that was submitted before,
+        the draft is not submitted again.
+        '''
+        if not hasattr(self, 'draftId'):
+            self.attach(self.draftUrl)
+
+        return b2sharePublication(self, timeout = timeout)
+
+    def patchGeneral(self, metadata, collPath = ''):
         '''
         Adds metadata to a B2SHARE draft.
         Mandatory metadata entries: CREATOR, TITLE
         If data is not uploaded it is advised to provide pids pointing to the data in iRODS or
         to provide tickets for anonym ous data download.
+        The patch is staged and sent with commit().
         '''
-        errorMsg = []
-        headers = {"Content-Type":"application/json-patch+json"}
-
         # CREATOR
-        patch = '[{"op":"add","path":"/creators","value":[{"creator_name":"' + \
-            metadata['CREATOR'] + '"}]}]'
-        response = requests.patch(url=self.draftUrl, headers=headers, data=patch)
-        if response.status_code not in range(200, 300):
-            errorMsg.append('B2SHARE PUBLISH ERROR: Draft not patched with creators. ' + \
-            str(response.status_code))
-        print "added creator"
+        self.patch.append({'op': 'add', 'path': '/creators',
+                           'value': [{'creator_name': metadata['CREATOR']}]})
 
         #DESCRIPTION: ABSTRACT, TOC, SERIESINFO, TECHNICALINFO
         #NOTE: metadata['TECHNICALINFO']=
         #'irods_host alice-centos; irods_port 1247; irods_user_name anonymous;
         #irods_zone_name aliceZone;
         #iget/ils -t <ticket> /aliceZone/home/public/b2share/myDeposit'
-        patch = '[{"op":"add","path":"/descriptions","value":[{"description":"'+ metadata['ABSTRACT'] + \
-            '", "description_type":"Abstract"},{"description":"'+ metadata['OTHER'] + \
-            '", "description_type":"Other"},{"description":"'+metadata['SERIESINFORMATION'] + \
-            '", "description_type":"SeriesInformation"}, {"description":"Ticket: '+metadata['TICKET'] + \
-            '", "description_type":"TableOfContents"}]}]'
-        response = requests.patch(url=self.draftUrl, headers=headers, data=patch)
-        if response.status_code not in range(200, 300):
-            errorMsg.append('B2SHARE PUBLISH ERROR: Draft not patched with description. ' + \
-            str(response.status_code))
-
-#        patch = '[{"op":"add","path":"/descriptions","value":[{"description":"'+metadata['TECHNICALINFO'] + \
-#            '", "description_type":"TechnicalInfo"}]}]'
-#        response = requests.patch(url=self.draftUrl, headers=headers, data=patch)
-#        if response.status_code not in range(200, 300):
-#            errorMsg.append('B2SHARE PUBLISH ERROR: Draft not patched with TECHNICALINFO. ' + \
-#            str(response.status_code))
+        descriptions = []
+        for key, prefix, descriptionType in [('ABSTRACT', '', 'Abstract'), ('OTHER', '', 'Other'),
+                ('SERIESINFORMATION', '', 'SeriesInformation'), ('TICKET', 'Ticket: ', 'TableOfContents')]:
+            if key in metadata:
+                descriptions.append({'description': prefix + metadata[key],
+                                     'description_type': descriptionType})
+        self.patch.append({'op': 'add', 'path': '/descriptions', 'value': descriptions})
 
-        print "added description"
-
-        return errorMsg
+        return []
 
     def patchTickets(self, tickets):
         '''
         Patches a draft with tickets as Resource Type.
         Expects a dictionary irods obj oath --> ticket
+        The patch is staged and sent with commit().
         '''
-        errorMsg = []
-        headers = {"Content-Type":"application/json-patch+json"}
-        tmp = []
-        for ticket in tickets:
-	    tmp.append('{"resource_type": "path='+ticket+' ticket='+tickets[ticket]+\
-            '", "resource_type_general": "Dataset"}')
-        patch = '[{"op":"add","path":"/resource_types","value":[' + ','.join(tmp)+']}]'
-        request = requests.patch(url=self.draftUrl, headers=headers, data=patch)
-        if request.status_code not in range(200, 300):
-            errorMsg.append('B2SHARE PUBLISH ERROR: Draft not patched with tickets. ' + str(request.status_code))
+        value = [{'resource_type': 'path=' + path + ' ticket=' + tickets[path],
+                  'resource_type_general': 'Dataset'} for path in tickets]
+        self.patch.append({'op': 'add', 'path': '/resource_types', 'value': value})
 
-        return errorMsg
+        return []
 
     def patchPIDs(self, pids):
         '''
         Patches a draft with PIDs as alternmate identifiers.
         Expects a diuctionary irods obj name --> pids
+        The patch is staged and sent with commit().
+        '''
+        value = [{'alternate_identifier': pids[name],
+                  'alternate_identifier_type': 'EPIC;' + name} for name in pids]
+        self.patch.append({'op': 'add', 'path': '/alternate_identifiers', 'value': value})
+
+        return []
+
+    def commit(self):
+        '''
+        Sends all staged patches in one json-patch request.
+        If B2SHARE rejects the request, the operations are sent in chunks of PATCHCHUNK.
         '''
         errorMsg = []
+        if self.patch == []:
+            return errorMsg
         headers = {"Content-Type":"application/json-patch+json"}
-        tmp = []
-        for pid in pids:
-            tmp.append('{"alternate_identifier": "'+pids[pid]+\
-                '", "alternate_identifier_type": "EPIC;'+\
-                pid+'"}')
-        patch = '[{"op":"add","path":"/alternate_identifiers","value":[' + ','.join(tmp)+']}]'
-        request = requests.patch(url=self.draftUrl, headers=headers, data=patch)
-        if request.status_code not in range(200, 300):
-            errorMsg.append('B2SHARE PUBLISH ERROR: Draft not patched with pids. ' + str(request.status_code))
+
+        response = self.session.patch(url=self.draftUrl, headers=headers, data=json.dumps(self.patch))
+        if response.status_code in range(200, 300):
+            self.patch = []
+            return errorMsg
+
+        failed = []
+        for i in range(0, len(self.patch), PATCHCHUNK):
+            chunk = self.patch[i:i+PATCHCHUNK]
+            response = self.session.patch(url=self.draftUrl, headers=headers, data=json.dumps(chunk))
+            if response.status_code not in range(200, 300):
+                failed.extend(chunk)
+                errorMsg.append('B2SHARE PUBLISH ERROR: Draft not patched with ' +
+                    ', '.join([op['path'] for op in chunk]) + '. ' + str(response.status_code))
+        self.patch = failed
 
         return errorMsg
 
-    def uploadData(self, folder):
+    def uploadData(self, folder, checksums = {}, workers = UPLOADWORKERS, progress = None):
+        '''
+        Uploads local files from a folder and its subfolders to the draft.
+        Files are stored under their path relative to folder.
+        checksums - dictionary relative path --> iRODS checksum to verify the files against.
+        See uploadStreams.
+        '''
+        streams = []
+        for root, dirs, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                relPath = os.path.relpath(path, folder)
+                streams.append((relPath, os.path.getsize(path), functools.partial(open, path, 'rb'),
+                    checksums.get(relPath)))
+
+        return self.uploadStreams(streams, workers, progress)
+
+    def uploadStreams(self, streams, workers = UPLOADWORKERS, progress = None):
         '''
-        Uploads local files from a folder to the draft.
+        Uploads data from streams to the draft without a local copy.
+        Expects an iterable of (name, size, opener, checksum) where opener() returns a readable
+        file-like object, e.g. an iRODS data object opened for reading, and checksum is the
+        iRODS checksum (md5 or sha2:<base64 sha256>) or None.
+        The data is sent as raw body, files are uploaded concurrently by workers threads
+        and each file is retried UPLOADRETRIES times.
+        The checksum returned by B2SHARE and the iRODS checksum are compared with the
+        checksum of the data that was sent.
+        Files which are already in the draft are skipped if their checksum matches, see isUploaded.
+        progress - callable(name, bytes sent, size)
         '''
         errorMsg = []
-        r = json.loads(requests.get(self.draftUrl).text)
-
-        for f in os.listdir(folder):
-            upload_files_url = r['links']['files'] + "/" + f + "?access_token=" + self.apiToken
-            files = {'file' : open(folder+"/"+f, 'rb')}
-            headers = {'Accept':'application/json',
-                'Content-Type':'application/octet-stream --data-binary'}
-            response = requests.put(url=upload_files_url,
-                headers = headers, files = files )
-            if response.status_code not in range(200, 300):
-                errorMsg.append('B2SHARE PUBLISH ERROR: File not uploaded ' +
-                    folder+"/"+f +', ' + str(request.status_code))
+        r = json.loads(self.session.get(self.draftUrl).text)
+        uploaded = self.uploadedFiles(r)
+
+        todo = [stream for stream in streams if not self.isUploaded(stream, uploaded.get(stream[0]))]
+        upload = functools.partial(self.uploadStream, r['links']['files'], progress = progress)
+        pool = ThreadPool(workers)
+        try:
+            for error in pool.imap_unordered(upload, todo):
+                if error:
+                    errorMsg.append(error)
+        finally:
+            pool.close()
+            pool.join()
 
         return errorMsg
 
-    def publish(self):
+    def uploadStream(self, filesUrl, stream, progress = None):
+        '''
+        Uploads one stream (name, size, opener, checksum) to the file bucket filesUrl.
+        Returns an error message or None.
+        '''
+        name, size, opener, checksum = stream
+        upload_files_url = filesUrl + "/" + urllib.quote(name) + "?access_token=" + self.apiToken
+        headers = {'Accept':'application/json',
+            'Content-Type':'application/octet-stream'}
 
-        headers = {"Content-Type":"application/json-patch+json"}
-        patch = '[{"op":"add", "path":"/publication_state", "value":"submitted"}]'
-        response = requests.patch(url=self.draftUrl, headers=headers, data=patch)
-        r = json.loads(requests.get(self.draftUrl).text)    
-        doi = r['metadata']['DOI']        
+        for attempt in range(UPLOADRETRIES):
+            try:
+                with opener() as f:
+                    reader = hashingReader(f, name, size, progress)
+                    response = self.session.put(url=upload_files_url, headers = headers, data = reader)
+            except Exception as e:
+                error = 'B2SHARE PUBLISH ERROR: File not uploaded ' + name + ', ' + repr(e)
+                continue
+            if response.status_code not in range(200, 300):
+                error = 'B2SHARE PUBLISH ERROR: File not uploaded ' + name + ', ' + \
+                    str(response.status_code)
+                continue
+            try:
+                repoChecksum = response.json().get('checksum', '')
+            except ValueError:
+                error = 'B2SHARE PUBLISH ERROR: No valid response for ' + name + ', ' + \
+                    str(response.status_code)
+                continue
+            error = self.checksumError(name, reader, repoChecksum, checksum)
+            if error is None:
+                return None
+
+        return error
 
-        return doi
+    def checksumError(self, name, reader, repoChecksum, irodsChecksum):
+        '''
+        Compares the checksums of the sent data with the checksums from B2SHARE (md5:<hex>)
+        and iRODS (sha2:<base64> or md5 hex). Returns an error message or None.
+        '''
+        md5 = reader.md5.hexdigest()
+        if repoChecksum.startswith('md5:') and repoChecksum[4:] != md5:
+            return 'B2SHARE PUBLISH ERROR: Checksum mismatch B2SHARE ' + name
+        if irodsChecksum:
+            if irodsChecksum.startswith('sha2:'):
+                match = base64.b64encode(reader.sha256.digest()) == irodsChecksum[5:]
+            else:
+                match = irodsChecksum == md5
+            if not match:
+                return 'B2SHARE PUBLISH ERROR: Checksum mismatch iRODS ' + name
+
+        return None
+
+    def isUploaded(self, stream, repoChecksum):
+        '''
+        Checks whether a file in the draft (checksum repoChecksum, md5:<hex>) is the data of
+        stream. An md5 iRODS checksum is compared directly, otherwise the data is read to
+        compute the md5, as B2SHARE does not report sha256 checksums.
+        '''
+        name, size, opener, checksum = stream
+        if not repoChecksum or not repoChecksum.startswith('md5:'):
+            return False
+        if checksum and not checksum.startswith('sha2:'):
+            return repoChecksum[4:] == checksum
+
+        try:
+            with opener() as f:
+                reader = hashingReader(f, name, size)
+                while reader.read(READSIZE):
+                    pass
+        except Exception:
+            #the upload reports the error
+            return False
+        return self.checksumError(name, reader, repoChecksum, checksum) is None
+
+    def uploadedFiles(self, record):
+        '''
+        Lists the files in the file bucket of a draft record.
+        Returns a dictionary file name --> checksum (md5:<hex>)
+        '''
+        response = self.session.get(record['links']['files'], params = {'access_token': self.apiToken})
+        if response.status_code not in range(200, 300):
+            return {}
+        return dict((f['key'], f.get('checksum')) for f in response.json().get('contents', []))
+
+    def publish(self, timeout = POLLTIMEOUT):
+        '''
+        Submits the draft for publication and waits for the DOI.
+        Returns the DOI or None if B2SHARE did not mint it within timeout seconds.
+        '''
+        return self.publishAsync(timeout).wait()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+@licence: Apache 2.0
+@Copyright (c) 2018, Christine Staiger (SURFsara)
+@author: Christine Staiger
+"""
+import time
+
+import requests
+
+from httpSession import getSession
+
+CKANTIMEOUT = (10, 120) # seconds to connect and to wait for the response
+CKANRETRIES = 3         # retries of actions on 5xx responses and failed connections
+CKANBACKOFF = 1         # seconds, doubled for each retry
+
+class ckanError(Exception):
+    '''
+    Raised if a CKAN action fails. status is the HTTP status code (None if the server
+    could not be reached), error the error dictionary of the CKAN response.
+    '''
+    def __init__(self, action, status, error = None):
+        self.action = action
+        self.status = status
+        self.error  = error or {}
+        Exception.__init__(self, '{0} failed ({1}): {2}'.format(action, status,
+            self.error.get('message', self.error)))
+
+class ckanNotFound(ckanError):
+    pass
+
+class ckanNotAuthorized(ckanError):
+    pass
+
+class ckanValidationError(ckanError):
+    pass
+
+class ckanServerError(ckanError):
+    pass
+
+ERRORS = {403: ckanNotAuthorized, 404: ckanNotFound, 409: ckanValidationError}
+
+class ckanClient():
+    '''
+    Client for the CKAN action API on the shared, pooled 'CKAN' session.
+    Actions are retried with backoff on 5xx responses and connection errors, except
+    *_create actions which could create a package twice.
+    '''
+
+    def __init__(self, apiUrl, apiToken, timeout = CKANTIMEOUT, retries = CKANRETRIES,
+                 backoff = CKANBACKOFF):
+        '''
+        apiUrl  - server, e.g. hostname:8080/api/3
+        timeout - seconds, (connect, read) tuple or a single number
+        '''
+        self.apiUrl   = apiUrl
+        self.apiToken = apiToken
+        self.timeout  = timeout
+        self.retries  = retries
+        self.backoff  = backoff
+        self.session  = getSession('CKAN')
+
+    def call(self, action, data = None):
+        '''
+        Calls the action with data as JSON body and returns the result of the action.
+        Raises ckanError or one of its subclasses.
+        '''
+        url = 'http://{api}/action/{action}'.format(api=self.apiUrl, action=action)
+        headers = {'Authorization': self.apiToken}
+        retries = 0 if action.endswith('_create') else self.retries
+
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(url, json = data or {}, headers = headers,
+                    timeout = self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise ckanServerError(action, None)
+                continue
+            if response.status_code < 500:
+                break
+        else:
+            raise ckanServerError(action, response.status_code)
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code == 200 and body.get('success'):
+            return body['result']
+        raise ERRORS.get(response.status_code, ckanError)(action, response.status_code,
+            body.get('error'))
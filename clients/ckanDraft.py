@@ -5,24 +5,50 @@
 @Copyright (c) 2018, Christine Staiger (SURFsara)
 @author: Christine Staiger
 """
-from urllib2 import quote
-import urllib2
-import simplejson as json
-from urllib2 import urlopen, Request
+from ckanClient import ckanClient, ckanError, ckanNotFound, CKANTIMEOUT
+import threading
 import uuid
 import os
 
+# Package names known to exist per CKAN api, shared by all drafts in the process
+_knownNames = {}
+_knownLock = threading.Lock()
+
+def knownNames(apiUrl):
+    with _knownLock:
+        return _knownNames.setdefault(apiUrl, set())
+
+def addKnownName(apiUrl, name):
+    with _knownLock:
+        _knownNames.setdefault(apiUrl, set()).add(name)
+
+def refreshKnownNames(client):
+    '''
+    Loads the names of all packages with one package_list call, e.g. before a batch run.
+    client - instance of ckanClient
+    '''
+    names = set(client.call('package_list'))
+    with _knownLock:
+        _knownNames[client.apiUrl] = names
+    return names
+
 class ckanDraft():
 
-    def __init__(self, apiToken, apiUrl, ckanOrg, ckanID = '', ckanGroup = ''):
+    def __init__(self, apiToken, apiUrl, ckanOrg, ckanID = '', ckanGroup = '', timeout = CKANTIMEOUT):
+        '''
+        timeout - seconds to connect and to wait for responses, see ckanClient
+        '''
         self.apiToken   = apiToken
         self.apiUrl     = apiUrl #server, e.g. hostname:8080/api/3
+        self.client     = ckanClient(apiUrl, apiToken, timeout = timeout)
         self.ckanOrg  	= ckanOrg
         self.ckanGroup   = ckanGroup
         self.ckanID	= ckanID # ckan name
         if self.ckanID == '':
             self.ckanID = str(uuid.uuid1())
         self.repoName   = 'CKAN'
+        self.data       = {}    # package metadata as far as known
+        self.changed    = set() # fields of self.data to send with commit()
         self.metaKeys   = ['TITLE', 'ABSTRACT', 'CREATOR']
         self.draftUrl   = 'http://{api}/dataset/{id}'.format(api=self.apiUrl.split('/api')[0], id=self.ckanID) 
 
@@ -30,34 +56,51 @@ class ckanDraft():
         '''
         Create a draft in CKAN with some minimal metadata.
         '''
-        action = "package_list"
-        action_url = 'http://{api}/action/{action}'.format(api=self.apiUrl, action=action)
-        print "Listing packages: ", action_url
-        response = urllib2.urlopen(action_url)
-        response_dict = json.loads(response.read())
-        
-        if self.ckanID in response_dict['result']:
+        try:
+            exists = self.exists()
+        except ckanError as e:
+            return ["Draft not created.", 'CKAN PUBLISH ERROR: ' + str(e)]
+        if exists:
             print "Draft already created: " + self.ckanID
             return ['CKAN PUBLISH INFO: Draft already exists: ' + self.ckanID]
  
         #create draft
-        action = 'package_create' # package_update
-        action_url = 'http://{api}/action/{action}'.format(api=self.apiUrl, action=action)
         data = {'title': title, 'owner_org': self.ckanOrg, 'name': self.ckanID}
         if self.ckanGroup != '':
             data['group'] = self.ckanGroup
             data['groups'] = [{'name': self.ckanGroup}]
-        data_string = quote(json.dumps(data))
-        request = Request(action_url, data_string)
-        request.add_header('Authorization', self.apiToken)
 
         try:
-            response = urlopen(request) # if name already exists or is not given throws 409
+            # if name already exists or is not given throws ckanValidationError (409)
+            self.client.call('package_create', data)
+            addKnownName(self.apiUrl, self.ckanID)
             self.data = data
             self.draftUrl = 'http://{api}/dataset/{id}'.format(api=self.apiUrl.split('/api')[0], id=self.ckanID)
             return 
-        except:
-            return ["Draft not created."] 
+        except ckanError as e:
+            return ["Draft not created.", 'CKAN PUBLISH ERROR: ' + str(e)]
+
+    def exists(self):
+        '''
+        Checks whether a package with the name self.ckanID exists, first among the known
+        names and then with package_show. Does not depend on the number of packages in CKAN.
+        '''
+        if self.ckanID in knownNames(self.apiUrl):
+            return True
+        try:
+            self.client.call('package_show', {'id': self.ckanID})
+        except ckanNotFound:
+            return False
+        addKnownName(self.apiUrl, self.ckanID)
+        return True
+
+    def attach(self, draftUrl):
+        '''
+        Continue working on an existing draft.
+        '''
+        self.ckanID = draftUrl.rstrip('/').split('/')[-1]
+        self.data = self.client.call('package_show', {'id': self.ckanID})
+        self.draftUrl = draftUrl
 
     def patchGeneral(self, metadata, collPath = 'irods'):
         '''
@@ -66,76 +109,78 @@ class ckanDraft():
         If data is not uploaded it is advised to provide pids pointing to the data in iRODS or
         to provide tickets for anonym ous data download.
         NOTE: If the draft already contains files, the update of metadata will fail.
+        The changes are staged and sent with commit().
         Parameters:
         metadata = ipc.mdGet()
         collPath = iRODS path or webdav access to collection or data object
         '''
-        errorMsg = []
-        curMeta = self.data
-        print curMeta
-
         # CREATOR --> author
-        curMeta['author'] = metadata['CREATOR'] 
-    
+        self.setField('author', metadata['CREATOR'])
         # ABSTRACT --> notes
-        curMeta['notes'] = metadata['ABSTRACT']
+        self.setField('notes', metadata['ABSTRACT'])
+        self.setField('url', collPath)
 
-        curMeta['url'] = collPath
-        if 'extras' not in curMeta:
-            curMeta['extras'] = []
         # TECHNICALINFO
         #if 'TECHNICALINFO' in metadata:
-        #    curMeta['extras'].append({'key': 'iRODS ticket access with icommands', 'value': metadata['TECHNICALINFO']})
+        #    self.setExtra('iRODS ticket access with icommands', metadata['TECHNICALINFO'])
         # OTHER
         if 'OTHER' in metadata:
-            curMeta['extras'].append({'key': 'Web access to iRODS instance', 'value': metadata['OTHER']})
+            self.setExtra('Web access to iRODS instance', metadata['OTHER'])
 
         # collection iRODS path, PID and ticket --> otherId
         if 'PID' in metadata:
-            curMeta['extras'].append({'key': 'Handle', 'value': 'hdl.handle.net/'+metadata['PID']})
+            self.setExtra('Handle', 'hdl.handle.net/'+metadata['PID'])
         if 'TICKET' in metadata:
-            curMeta['extras'].append({'key': 'Other ID', 'value': metadata['TICKET']})
- 
-        print curMeta
-        #update CKAN entry
-        action = 'package_update'
-        action_url = 'http://{api}/action/{action}'.format(api=self.apiUrl, action=action)
-        data_string = quote(json.dumps(curMeta))
-        request = Request(action_url, data_string)
-        request.add_header('Authorization', self.apiToken)    
-        try:
-            response = urlopen(request) # if name already exists or is not given throws 409
-            self.data = curMeta
-            errorMsg.append('CKAN PUBLISH INFO: Draft patched')
-        except:
-            errorMsg.append('CKAN PUBLISH ERROR: Draft not patched with with new metadata:' +
-                'CREATOR, ABSTRACT, TECHNICALINFO, OTHER, PID or TICKET.')        
-        return errorMsg
+            self.setExtra('Other ID', metadata['TICKET'])
+
+        return []
 
     def patchRefs(self, refs, prefix = 'hdl.handle.net/'):
         '''
         Patches a draft with tickets and pids for data objects as otherReferences.
         Expects a dictionary irods obj path --> ticket
+        The changes are staged and sent with commit().
         '''
-        errorMsg = []
-        curMeta = self.data
         if prefix == 'hdl.handle.net/':
-            curMeta['extras'].append({'key': 'File Handles',
-                'value': str([os.path.basename(ref)+'> '+prefix+refs[ref] for ref in refs])})
+            self.setExtra('File Handles',
+                str([os.path.basename(ref)+'> '+prefix+refs[ref] for ref in refs]))
         else:
-            curMeta['extras'].append({'key': 'iRODS ticket', 
-                'value': str([ref+' '+prefix+refs[ref] for ref in refs])})
+            self.setExtra('iRODS ticket', str([ref+' '+prefix+refs[ref] for ref in refs]))
+
+        return []
 
-        action = 'package_update'
-        action_url = 'http://{api}/action/{action}'.format(api=self.apiUrl, action=action)
-        data_string = quote(json.dumps(curMeta))
-        request = Request(action_url, data_string)
-        request.add_header('Authorization', self.apiToken)
+    def setField(self, key, value):
+        if self.data.get(key) != value:
+            self.data[key] = value
+            self.changed.add(key)
 
+    def setExtra(self, key, value):
+        '''
+        Sets the extra with key, an existing extra with the same key is replaced.
+        '''
+        extras = self.data.setdefault('extras', [])
+        current = next((extra for extra in extras if extra['key'] == key), None)
+        if current is None:
+            extras.append({'key': key, 'value': value})
+        elif current['value'] == value:
+            return
+        else:
+            current['value'] = value
+        self.changed.add('extras')
+
+    def commit(self):
+        '''
+        Sends the changed fields of all staged patches in one package_patch request.
+        CKAN replaces list fields as a whole, so extras are always sent completely.
+        '''
+        if not self.changed:
+            return []
+        delta = dict((key, self.data[key]) for key in self.changed)
+        delta['id'] = self.ckanID
         try:
-            response = urlopen(request) # if name already exists or is not given throws 409
-            self.data = curMeta
-            errorMsg.append('Dataverse PUBLISH INFO: Draft patched with refs: '+str(refs))
-        except:
-            errorMsg.append('Dataverse PUBLISH ERROR: Draft not patched with data references.')
-        return errorMsg
+            self.client.call('package_patch', delta)
+        except ckanError as e:
+            return ['CKAN PUBLISH ERROR: Draft not patched with ' + ', '.join(sorted(self.changed)) +
+                '. ' + str(e)]
+        self.changed = set()
+        return ['CKAN PUBLISH INFO: Draft patched']
@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+from dataverse.settings import CACHE_TTL
+
+_entries = {}
+_lock = threading.Lock()
+
+
+def get(host, token, kind, name=None):
+    """Returns the cached value, or None if it is missing or expired."""
+    key = (host, token, kind, name)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            del _entries[key]
+            return None
+        return value
+
+
+def put(host, token, kind, name=None, value=None, ttl=CACHE_TTL):
+    """Caches a value for `ttl` seconds."""
+    with _lock:
+        _entries[(host, token, kind, name)] = (time.time() + ttl, value)
+    return value
+
+
+def invalidate(host, token=None, kind=None, name=None):
+    """Removes all entries of a host that match the given token, kind and name.
+
+    Arguments that are None match any value, so entries are removed for all
+    tokens when `token` is None.
+    """
+    with _lock:
+        for key in list(_entries):
+            if key[0] != host:
+                continue
+            if all(wanted is None or wanted == actual
+                   for wanted, actual in zip((token, kind, name), key[1:])):
+                del _entries[key]
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -2,17 +2,66 @@ from __future__ import absolute_import
 
 from lxml import etree
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from dataverse.dataverse import Dataverse
-from dataverse import exceptions
+from dataverse import cache, exceptions
+from dataverse.settings import (
+    POOL_SIZE, RETRIES, RETRY_BACKOFF, RETRY_STATUS, CONNECT_TIMEOUT,
+    READ_TIMEOUT,
+)
 from dataverse.utils import get_elements
 
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+class Session(requests.Session):
+    """Pooled session that applies a default timeout to every request.
+
+    Only idempotent requests are retried, a retried POST could create a
+    dataset or file twice.
+    """
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 pool_size=POOL_SIZE, retries=RETRIES):
+        super(Session, self).__init__()
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUS,
+            method_whitelist=IDEMPOTENT_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(Session, self).request(method, url, **kwargs)
+
 
 class Connection(object):
 
-    def __init__(self, host, token, use_https=True):
+    def __init__(self, host, token, use_https=True,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=POOL_SIZE,
+                 retries=RETRIES):
+        """
+        :param timeout: seconds, (connect, read) tuple or a single number
+        :param int pool_size: connections kept alive, at least the number of
+            concurrent uploads
+        :param int retries: retries of idempotent requests
+        """
         self.token = token
         self.host = host
+        self.session = Session(timeout, pool_size, retries)
 
         if use_https:
             url_scheme = 'https://'
@@ -31,21 +80,28 @@ class Connection(object):
         return self.token, None
 
     def get_service_document(self, refresh=False):
-        if not refresh and self._service_document is not None:
-            return self._service_document
+        # Shared by all connections with the same host and token
+        if not refresh:
+            service_document = cache.get(self.host, self.token, 'service-document')
+            if service_document is not None:
+                self._service_document = service_document
+                return service_document
 
-        resp = requests.get(self.sd_uri, auth=self.auth)
+        resp = self.session.get(self.sd_uri, auth=self.auth)
 
         if resp.status_code == 403:
             raise exceptions.UnauthorizedError('The credentials provided are invalid.')
         elif resp.status_code != 200:
             raise exceptions.ConnectionError('Could not connect to the Dataverse')
 
-        self._service_document = etree.XML(resp.content)
+        self._service_document = cache.put(
+            self.host, self.token, 'service-document',
+            value=etree.XML(resp.content),
+        )
         return self._service_document
 
     def create_dataverse(self, alias, name, email, parent=':root'):
-        resp = requests.post(
+        resp = self.session.post(
             '{0}/dataverses/{1}'.format(self.native_base_url, parent),
             json={
                 'alias': alias,
@@ -64,12 +120,13 @@ class Connection(object):
                 '{0} Dataverse could not be created.'.format(name)
             )
 
+        cache.invalidate(self.host, kind='service-document')
         self.get_service_document(refresh=True)
         return self.get_dataverse(alias)
 
     def delete_dataverse(self, dataverse):
 
-        resp = requests.delete(
+        resp = self.session.delete(
             '{0}/dataverses/{1}'.format(self.native_base_url, dataverse.alias),
             params={'key': self.token},
         )
@@ -87,6 +144,8 @@ class Connection(object):
                 'Dataverse {0} could not be deleted.'.format(dataverse.alias)
             )
 
+        cache.invalidate(self.host, kind='service-document')
+        cache.invalidate(self.host, name=dataverse.alias)
         self.get_service_document(refresh=True)
 
     def get_dataverses(self, refresh=False):
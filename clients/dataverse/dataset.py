@@ -2,6 +2,9 @@ from __future__ import absolute_import
 
 import os
 import json
+import re
+import time
+from multiprocessing.pool import ThreadPool
 
 try:
     from StringIO import StringIO
@@ -18,8 +21,12 @@ from .exceptions import (
     ConnectionError, MetadataNotFoundError, VersionJsonNotFoundError,
 )
 from dataverse.file import DataverseFile
-from dataverse.settings import SWORD_BOOTSTRAP
-from dataverse.utils import get_element, get_files_in_path, add_field
+from dataverse.settings import (
+    SWORD_BOOTSTRAP, UPLOAD_WORKERS, LOCK_RETRIES, LOCK_WAIT,
+)
+from dataverse.utils import (
+    get_element, get_files_in_path, add_field, iter_zip, multipart_file,
+)
 
 
 class Dataset(object):
@@ -41,6 +48,7 @@ class Dataset(object):
 
         self._entry = etree.XML(entry) if isinstance(entry, str) else entry
         self._statement = None
+        self._parsed_statement = None
         self._metadata = {}
         self._id = None
 
@@ -100,22 +108,15 @@ class Dataset(object):
         if not self.dataverse:
             raise NoContainerError('This dataset has not been added to a Dataverse.')
 
-        for dataset in self.dataverse.get_contents(refresh=True):
-            doi = '{0}:{1}/{2}'.format(
-                dataset['protocol'],
-                dataset['authority'],
-                dataset['identifier'],
-            )
-            if doi == self.doi:
-                self._id = dataset['id']
-                return self._id
-
-        raise MetadataNotFoundError('The dataset ID could not be found.')
+        self._id = self.dataverse.get_dataset_id(self.doi)
+        if self._id is None:
+            raise MetadataNotFoundError('The dataset ID could not be found.')
+        return self._id
 
     @property
     def citation(self):
         return get_element(
-            self.get_entry(),
+            self._get_entry_element(),
             namespace='http://purl.org/dc/terms/',
             tag='bibliographicCitation'
         ).text
@@ -128,7 +129,7 @@ class Dataset(object):
         if not refresh and self._entry is not None:
             return etree.tostring(self._entry)
 
-        resp = requests.get(self.edit_uri, auth=self.connection.auth)
+        resp = self.connection.session.get(self.edit_uri, auth=self.connection.auth)
 
         if resp.status_code != 200:
             raise ConnectionError('Atom entry could not be retrieved.')
@@ -137,6 +138,11 @@ class Dataset(object):
         self._entry = etree.XML(entry_string)
         return entry_string
 
+    def _get_entry_element(self, refresh=False):
+        if refresh or self._entry is None:
+            self.get_entry(refresh=True)
+        return self._entry
+
     def get_statement(self, refresh=False):
         if not refresh and self._statement:
             return self._statement
@@ -147,7 +153,7 @@ class Dataset(object):
         if not self.statement_uri:
             # Try to find statement uri without a request to the server
             link = get_element(
-                self.get_entry(),
+                self._get_entry_element(),
                 tag='link',
                 attribute='rel',
                 attribute_value='http://purl.org/net/sword/terms/statement',
@@ -155,14 +161,14 @@ class Dataset(object):
             if link is None:
                 # Find link with request to server
                 link = get_element(
-                    self.get_entry(refresh=True),
+                    self._get_entry_element(refresh=True),
                     tag='link',
                     attribute='rel',
                     attribute_value='http://purl.org/net/sword/terms/statement',
                 )
             self.statement_uri = link.get('href')
 
-        resp = requests.get(self.statement_uri, auth=self.connection.auth)
+        resp = self.connection.session.get(self.statement_uri, auth=self.connection.auth)
 
         if resp.status_code != 200:
             raise ConnectionError('Statement could not be retrieved.')
@@ -170,12 +176,19 @@ class Dataset(object):
         self._statement = resp.content
         return self._statement
 
+    def _get_statement_element(self, refresh=False):
+        # Parse each retrieved statement only once
+        statement = self.get_statement(refresh)
+        if self._parsed_statement is None or self._parsed_statement[0] is not statement:
+            self._parsed_statement = (statement, etree.XML(statement))
+        return self._parsed_statement[1]
+
     def get_state(self, refresh=False):
         if self.is_deleted:
             return 'DEACCESSIONED'
 
         return get_element(
-            self.get_statement(refresh),
+            self._get_statement_element(refresh),
             tag='category',
             attribute='term',
             attribute_value='latestVersionState'
@@ -194,7 +207,7 @@ class Dataset(object):
             version,
         )
 
-        resp = requests.get(url, params={'key': self.connection.token})
+        resp = self.connection.session.get(url, params={'key': self.connection.token})
 
         if resp.status_code == 404:
             raise VersionJsonNotFoundError(
@@ -227,7 +240,7 @@ class Dataset(object):
             self.connection.native_base_url,
             self.id,
         )
-        resp = requests.put(
+        resp = self.connection.session.put(
             url,
             headers={'Content-type': 'application/json'},
             data=json.dumps(metadata),
@@ -241,6 +254,35 @@ class Dataset(object):
         self._metadata['draft'] = updated_metadata
         self._metadata['latest'] = updated_metadata
 
+    def edit_metadata(self, fields, replace=True):
+        """Updates only the given fields of the dataset draft.
+        Will create a draft version if none exists.
+
+        :param list fields: field json, e.g. from
+            `DatasetMetadata.get_changed_fields`
+        :param bool replace: replace existing values instead of adding to them
+        """
+        url = '{0}/datasets/{1}/editMetadata'.format(
+            self.connection.native_base_url,
+            self.id,
+        )
+        params = {'key': self.connection.token}
+        if replace:
+            params['replace'] = 'true'
+        resp = self.connection.session.put(
+            url,
+            headers={'Content-type': 'application/json'},
+            data=json.dumps({'fields': fields}),
+            params=params,
+        )
+
+        if resp.status_code != 200:
+            raise OperationFailedError('JSON metadata could not be edited.')
+
+        updated_metadata = resp.json()['data']
+        self._metadata['draft'] = updated_metadata
+        self._metadata['latest'] = updated_metadata
+
     def create_draft(self):
         """Create draft version of dataset without changing metadata"""
         metadata = self.get_metadata(refresh=True)
@@ -251,7 +293,7 @@ class Dataset(object):
         if not self.dataverse.is_published:
             raise UnpublishedDataverseError('Host Dataverse must be published.')
 
-        resp = requests.post(
+        resp = self.connection.session.post(
             self.edit_uri,
             headers={'In-Progress': 'false', 'Content-Length': 0},
             auth=self.connection.auth,
@@ -282,20 +324,130 @@ class Dataset(object):
     def upload_filepath(self, filepath):
         self.upload_filepaths([filepath])
 
-    def upload_filepaths(self, filepaths):
-        # Convert a directory to a list of files
+    def upload_filepaths(self, filepaths, root=None, native=False,
+                         descriptions=None, workers=UPLOAD_WORKERS):
+        """Uploads files without reading them into memory.
+
+        By default the files are sent as one zip archive that is built while
+        streaming. With `native` each file is sent on its own through the
+        native API, `workers` files at a time, which keeps the directory
+        structure as file labels. Files that fail do not stop the others;
+        the metadata is refreshed once after all uploads.
+
+        :param dict descriptions: file path (relative to `root` if given)
+            -> file description, native API only
+        """
+        # Convert a directory to a list of files, keep paths relative to the directory
         if len(filepaths) == 1 and os.path.isdir(filepaths[0]):
-            filepaths = get_files_in_path(filepaths[0])
+            root = filepaths[0]
+            filepaths = get_files_in_path(root)
+
+        if not native:
+            arcnames = [os.path.relpath(path, root) for path in filepaths] if root else None
+            self._post_zip(iter_zip(filepaths, arcnames))
+            return
+
+        descriptions = descriptions or {}
+        # Resolve the id once, not in every worker
+        self.id
+
+        def add(filepath):
+            name = os.path.relpath(filepath, root) if root else filepath
+            try:
+                self.add_file(
+                    filepath,
+                    description=descriptions.get(name),
+                    directory_label=os.path.dirname(name) if root else None,
+                    refresh=False,
+                )
+            except (OperationFailedError, requests.RequestException):
+                return filepath
+            return None
+
+        pool = ThreadPool(max(1, workers))
+        try:
+            failed = [path for path in pool.imap(add, filepaths) if path]
+        finally:
+            pool.close()
+            pool.join()
+
+        self.get_metadata(refresh=True)
+
+        if failed:
+            raise OperationFailedError(
+                'The files could not be added: {0}'.format(', '.join(failed))
+            )
+
+    def add_file(self, filepath, description=None, directory_label=None,
+                 refresh=True):
+        """Uploads a single file through the native API, streamed from disk.
+
+        Retries while the dataset is locked, e.g. by the ingest of a
+        previous file.
+
+        :param str description: file description shown in Dataverse
+        :param str directory_label: folder of the file within the dataset
+        """
+        url = '{0}/datasets/{1}/add'.format(
+            self.connection.native_base_url,
+            self.id,
+        )
+        json_data = {}
+        if description:
+            json_data['description'] = description
+        if directory_label:
+            json_data['directoryLabel'] = directory_label
+
+        for attempt in range(LOCK_RETRIES + 1):
+            body, content_type = multipart_file(
+                filepath,
+                os.path.basename(filepath),
+                fields={'jsonData': json.dumps(json_data)},
+            )
+            resp = self.connection.session.post(
+                url,
+                data=body,
+                headers={'Content-Type': content_type},
+                params={'key': self.connection.token},
+            )
+            if resp.status_code == 200 or not self._is_locked(resp):
+                break
+            time.sleep(LOCK_WAIT)
 
-        # Zip up files
-        s = StringIO()
-        zip_file = ZipFile(s, 'w')
-        for filepath in filepaths:
-            zip_file.write(filepath)
-        zip_file.close()
-        content = s.getvalue()
+        if resp.status_code != 200:
+            raise OperationFailedError(
+                'The file {0} could not be added.'.format(filepath)
+            )
 
-        self.upload_file('temp.zip', content, zip_files=False)
+        if refresh:
+            self.get_metadata(refresh=True)
+
+    def get_locks(self):
+        """Returns the lock types of the dataset, or None if unavailable."""
+        resp = self.connection.session.get(
+            '{0}/datasets/{1}/locks'.format(
+                self.connection.native_base_url, self.id,
+            ),
+            params={'key': self.connection.token},
+        )
+        try:
+            locks = resp.json()['data'] if resp.status_code == 200 else None
+        except (ValueError, KeyError, TypeError):
+            return None
+        return [lock.get('lockType') for lock in locks] if locks is not None else None
+
+    def _is_locked(self, resp):
+        """Checks whether a refused request failed because of a dataset lock."""
+        if resp.status_code not in (400, 403, 409):
+            return False
+        if self.get_locks():
+            return True
+        # The lock may have been released meanwhile, the message tells
+        try:
+            message = resp.json().get('message') or ''
+        except (ValueError, AttributeError):
+            return False
+        return re.search(r'\block(ed)?\b', message, re.IGNORECASE) is not None
 
     def upload_file(self, filename, content, zip_files=True):
         if zip_files:
@@ -307,13 +459,17 @@ class Dataset(object):
             filename = 'temp.zip'
             content = s.getvalue()
 
+        self._post_zip(content, filename)
+
+    def _post_zip(self, content, filename='temp.zip'):
+        # content may be a generator, requests then sends it chunked
         headers = {
             'Content-Disposition': 'filename={0}'.format(filename),
             'Content-Type': 'application/zip',
             'Packaging': 'http://purl.org/net/sword/package/SimpleZip',
         }
 
-        requests.post(
+        self.connection.session.post(
             self.edit_media_uri,
             data=content,
             headers=headers,
@@ -324,7 +480,7 @@ class Dataset(object):
         # Note: We can't determine which file was uploaded. Returns None
 
     def delete_file(self, dataverse_file):
-        resp = requests.delete(
+        resp = self.connection.session.delete(
             dataverse_file.edit_media_uri,
             auth=self.connection.auth,
         )
@@ -337,29 +493,33 @@ class Dataset(object):
     # If we perform a server operation, we should refresh the dataset object
     def _refresh(self, receipt=None):
         if receipt:
-            self.edit_uri = get_element(
-                receipt,
-                tag='link',
-                attribute='rel',
-                attribute_value='edit'
-            ).get('href')
-            self.edit_media_uri = get_element(
-                receipt,
-                tag='link',
-                attribute='rel',
-                attribute_value='edit-media'
-            ).get('href')
-            self.statement_uri = get_element(
-                receipt,
-                tag='link',
-                attribute='rel',
-                attribute_value='http://purl.org/net/sword/terms/statement'
-            ).get('href')
+            self._read_receipt(receipt)
 
         self.get_statement(refresh=True)
         self.get_entry(refresh=True)
         self.get_metadata('latest', refresh=True)
 
+    def _read_receipt(self, receipt):
+        receipt = etree.XML(receipt)
+        self.edit_uri = get_element(
+            receipt,
+            tag='link',
+            attribute='rel',
+            attribute_value='edit'
+        ).get('href')
+        self.edit_media_uri = get_element(
+            receipt,
+            tag='link',
+            attribute='rel',
+            attribute_value='edit-media'
+        ).get('href')
+        self.statement_uri = get_element(
+            receipt,
+            tag='link',
+            attribute='rel',
+            attribute_value='http://purl.org/net/sword/terms/statement'
+        ).get('href')
+
     def _fixURLs(self):
         if self.connection.host.endswith(':8080') and self.connection.host != 'localhost':
             self.edit_uri = self.edit_uri.replace('https', 'http')
@@ -1,12 +1,13 @@
 from __future__ import absolute_import
 
-import requests
-
+from dataverse import cache
 from dataverse.dataset import Dataset
 from dataverse.exceptions import (
     ConnectionError, MethodNotAllowedError, OperationFailedError,
 )
-from dataverse.utils import get_element, get_elements, sanitize
+from lxml import etree
+
+from dataverse.utils import get_element, iter_entries, sanitize
 
 
 class Dataverse(object):
@@ -19,20 +20,16 @@ class Dataverse(object):
             href = href.replace('8080:8080', '8080')
             self.collection.set('href', href)
 
-        self._collection_info = None
-        self._contents_json = None
+        self._parsed_info = None
+        self._index = None
+        self._ids = None
+        self._dois = None
 
     @property
     def is_published(self):
-
-        # Always check latest version
-        collection_info = requests.get(
-            self.collection.get('href'),
-            auth=self.connection.auth,
-        ).content
-
+        # The cached state expires after CACHE_TTL and is dropped by publish()
         status_tag = get_element(
-            collection_info,
+            self._get_collection_element(),
             namespace='http://purl.org/net/sword/terms/state',
             tag='dataverseHasBeenReleased',
         )
@@ -53,13 +50,15 @@ class Dataverse(object):
         ).text)
 
     def get_contents(self, refresh=False):
-        if not refresh and self._contents_json:
-            return self._contents_json
+        if not refresh:
+            contents_json = self._cached('contents')
+            if contents_json is not None:
+                return contents_json
 
         content_uri = '{0}/dataverses/{1}/contents'.format(
             self.connection.native_base_url, self.alias
         )
-        resp = requests.get(
+        resp = self.connection.session.get(
             content_uri,
             params={'key': self.connection.token}
         )
@@ -67,25 +66,132 @@ class Dataverse(object):
         if resp.status_code != 200:
             raise ConnectionError('Atom entry could not be retrieved.')
 
-        self._contents_json = resp.json()['data']
-        return self._contents_json
+        return self._cache('contents', resp.json()['data'])
+
+    def get_dataset_id(self, doi, refresh=False):
+        """Returns the database id of the dataset with the DOI, or None.
+
+        Ids are indexed from the contents JSON, which is retrieved once. A DOI
+        that is not in the index is looked up on its own.
+        """
+        ids = self._get_ids(refresh)
+        if doi not in ids:
+            dataset_id = self._fetch_dataset_id(doi)
+            if dataset_id is None:
+                return None
+            self._ids[doi] = dataset_id
+            self._dois[dataset_id] = doi
+        return ids[doi]
+
+    def _get_ids(self, refresh=False):
+        if refresh or self._ids is None:
+            self._ids = dict(
+                ('{0}:{1}/{2}'.format(
+                    item['protocol'], item['authority'], item['identifier'],
+                ), item['id'])
+                for item in self.get_contents(refresh)
+                if item.get('type', 'dataset') == 'dataset'
+            )
+            self._dois = dict((i, doi) for doi, i in self._ids.items())
+        return self._ids
+
+    def _fetch_dataset_id(self, doi):
+        resp = self.connection.session.get(
+            '{0}/datasets/:persistentId/'.format(self.connection.native_base_url),
+            params={'persistentId': doi, 'key': self.connection.token},
+        )
+        if resp.status_code != 200:
+            return None
+        return resp.json()['data']['id']
+
+    def _get_index(self, refresh=False, timeout=None):
+        """Returns the datasets in feed order and indexed by DOI and title."""
+        if refresh or self._index is None:
+            datasets = self.get_datasets(refresh, timeout=timeout)
+            index = {'datasets': datasets, 'doi': {}, 'title': {}}
+            for dataset in datasets:
+                index['doi'].setdefault(dataset.doi, dataset)
+                index['title'].setdefault(dataset.title, dataset)
+            self._index = index
+        return self._index
+
+    def _index_dataset(self, dataset):
+        if self._index is not None:
+            self._index['datasets'].append(dataset)
+            self._index['doi'].setdefault(dataset.doi, dataset)
+            self._index['title'].setdefault(dataset.title, dataset)
+        if self._ids is not None and dataset._id:
+            self._ids[dataset.doi] = dataset._id
+            self._dois[dataset._id] = dataset.doi
+
+    def _add_contents(self, dataset):
+        contents_json = self._cached('contents')
+        # Other users' listings are fetched again
+        self._invalidate('contents')
+        if contents_json is None or not dataset._id:
+            return
+        protocol, doi = dataset.doi.split(':', 1)
+        authority, identifier = doi.split('/', 1)
+        self._cache('contents', contents_json + [{
+            'type': 'dataset',
+            'id': dataset._id,
+            'protocol': protocol,
+            'authority': authority,
+            'identifier': identifier,
+        }])
+
+    def _unindex_dataset(self, dataset):
+        if self._index is not None:
+            datasets = [s for s in self._index['datasets'] if s.doi != dataset.doi]
+            self._index['datasets'] = datasets
+            self._index['doi'].pop(dataset.doi, None)
+            indexed = self._index['title'].get(dataset.title)
+            if indexed is not None and indexed.doi == dataset.doi:
+                # Another dataset may have the same title
+                self._index['title'].pop(dataset.title)
+                match = next((s for s in datasets if s.title == dataset.title), None)
+                if match is not None:
+                    self._index['title'][dataset.title] = match
+        if self._ids is not None:
+            self._dois.pop(self._ids.pop(dataset.doi, None), None)
 
     def get_collection_info(self, refresh=False, timeout=None):
-        if not refresh and self._collection_info:
-            return self._collection_info
+        if not refresh:
+            collection_info = self._cached('collection-info')
+            if collection_info is not None:
+                return collection_info
 
-        self._collection_info = requests.get(
+        collection_info = self.connection.session.get(
             self.collection.get('href'),
             auth=self.connection.auth,
             timeout=timeout,
         ).content
-        return self._collection_info
+        return self._cache('collection-info', collection_info)
+
+    def _get_collection_element(self, refresh=False):
+        # Parse each retrieved collection info only once
+        collection_info = self.get_collection_info(refresh)
+        if self._parsed_info is None or self._parsed_info[0] is not collection_info:
+            self._parsed_info = (collection_info, etree.XML(collection_info))
+        return self._parsed_info[1]
+
+    def _cached(self, kind):
+        return cache.get(self.connection.host, self.connection.token, kind, self.alias)
+
+    def _cache(self, kind, value):
+        return cache.put(
+            self.connection.host, self.connection.token, kind, self.alias, value,
+        )
+
+    def _invalidate(self, kind=None):
+        # Other users' views of this Dataverse changed as well
+        cache.invalidate(self.connection.host, kind=kind, name=self.alias)
 
     def publish(self):
         edit_uri = '{0}/edit/dataverse/{1}'.format(
             self.connection.sword_base_url, self.alias
         )
-        resp = requests.post(
+        resp = self.connection.session.post(
             edit_uri,
             headers={'In-Progress': 'false'},
             auth=self.connection.auth,
@@ -94,6 +200,8 @@ class Dataverse(object):
         if resp.status_code != 200:
             raise OperationFailedError('The Dataverse could not be published.')
 
+        self._invalidate('collection-info')
+
     def create_dataset(self, title, description, creator, **kwargs):
         dataset = Dataset(
             title=title,
@@ -107,7 +215,7 @@ class Dataverse(object):
 
     def _add_dataset(self, dataset):
 
-        resp = requests.post(
+        resp = self.connection.session.post(
             self.collection.get('href'),
             data=dataset.get_entry(),
             headers={'Content-type': 'application/atom+xml'},
@@ -121,14 +229,19 @@ class Dataverse(object):
             response = resp.content.replace("8080:8080", "8080")
             response = response.replace("https", "http")
         dataset.dataverse = self
-        dataset._refresh(receipt=response)
-        self.get_collection_info(refresh=True)
+        dataset._read_receipt(response)
+        # Resolve the new id alone instead of listing the contents again
+        dataset._id = self._fetch_dataset_id(dataset.doi)
+        self._invalidate('collection-info')
+        self._add_contents(dataset)
+        self._index_dataset(dataset)
+        dataset._refresh()
 
     def delete_dataset(self, dataset):
         if dataset.get_state() == 'DELETED' or dataset.get_state() == 'DEACCESSIONED':
             return
 
-        resp = requests.delete(
+        resp = self.connection.session.delete(
             dataset.edit_uri,
             auth=self.connection.auth,
         )
@@ -140,27 +253,33 @@ class Dataverse(object):
             )
 
         dataset.is_deleted = True
-        self.get_collection_info(refresh=True)
+        self._invalidate()
+        self._unindex_dataset(dataset)
 
     def get_datasets(self, refresh=False, timeout=None):
+        return list(self.iter_datasets(refresh, timeout=timeout))
+
+    def iter_datasets(self, refresh=False, timeout=None):
+        """Yields the datasets while the collection feed is parsed."""
         collection_info = self.get_collection_info(refresh, timeout=timeout)
-        entries = get_elements(collection_info, tag='entry')
-        return [Dataset.from_dataverse(entry, self) for entry in entries]
+        for entry in iter_entries(collection_info):
+            yield Dataset.from_dataverse(entry, self)
 
     def get_dataset_by_doi(self, doi, refresh=False, timeout=None):
-        return next(
-            (s for s in self.get_datasets(refresh, timeout=timeout) if s.doi == doi),
-            None
-        )
+        return self._get_index(refresh, timeout=timeout)['doi'].get(doi)
 
     def get_dataset_by_title(self, title, refresh=False, timeout=None):
-        return next(
-            (s for s in self.get_datasets(refresh, timeout=timeout) if s.title == title),
-            None
+        return self._get_index(refresh, timeout=timeout)['title'].get(title)
+
+    def get_dataset_by_id(self, dataset_id, refresh=False, timeout=None):
+        self._get_ids(refresh)
+        return self.get_dataset_by_doi(
+            self._dois.get(dataset_id), refresh, timeout=timeout
         )
 
     def get_dataset_by_string_in_entry(self, string, refresh=False, timeout=None):
         return next(
-            (s for s in self.get_datasets(refresh, timeout=timeout) if string in s.get_entry()),
+            (s for s in self._get_index(refresh, timeout=timeout)['datasets']
+             if string in s.get_entry()),
             None
         )
@@ -4,10 +4,11 @@ from dataverse.utils import sanitize
 
 
 class DataverseFile(object):
-    def __init__(self, dataset, name, file_id=None):
+    def __init__(self, dataset, name, file_id=None, directory_label=None):
         self.dataset = dataset
         self.name = sanitize(name)
         self.id = file_id
+        self.directory_label = directory_label
 
         self.download_url = '{0}/access/datafile/{1}'.format(
             dataset.connection.native_base_url, self.id
@@ -25,4 +26,11 @@ class DataverseFile(object):
         except KeyError:
             name = json['datafile']['name']
             file_id = json['datafile']['id']
-        return cls(dataset, name, file_id)
+        return cls(dataset, name, file_id, json.get('directoryLabel'))
+
+    @property
+    def path(self):
+        """Path of the file within the dataset, folder and name."""
+        if self.directory_label:
+            return '{0}/{1}'.format(self.directory_label, self.name)
+        return self.name
@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+
+from dataverse.exceptions import MetadataNotFoundError
+
+
+def primitive_field(type_name, value, multiple=False):
+    return {
+        'typeName': type_name,
+        'typeClass': 'primitive',
+        'multiple': multiple,
+        'value': value,
+    }
+
+
+def compound_field(type_name, values, multiple=True):
+    """Returns a compound field.
+
+    :param list values: dicts subfield typeName -> primitive value, one per
+        value of the field
+    """
+    compounds = [
+        dict((key, primitive_field(key, value)) for key, value in item.items())
+        for item in values
+    ]
+    return {
+        'typeName': type_name,
+        'typeClass': 'compound',
+        'multiple': multiple,
+        'value': compounds if multiple else compounds[0],
+    }
+
+
+class DatasetMetadata(object):
+    """Version JSON of a dataset with its fields indexed by typeName.
+
+    Fields are changed in place in the wrapped JSON, which therefore stays a
+    valid argument for `Dataset.update_metadata`. The changed fields alone
+    are returned by `get_changed_fields` for `Dataset.edit_metadata`.
+    """
+    def __init__(self, version_json):
+        self.json = version_json
+        self._fields = {}
+        self._changed = []
+        self._changed_keys = set()
+
+        blocks = version_json.setdefault('metadataBlocks', {})
+        for block_name, block in blocks.items():
+            self._fields[block_name] = dict(
+                (field['typeName'], field) for field in block.get('fields', [])
+            )
+
+    def get_field(self, type_name, block='citation'):
+        return self._fields.get(block, {}).get(type_name)
+
+    def get_value(self, type_name, block='citation'):
+        field = self.get_field(type_name, block)
+        return field['value'] if field else None
+
+    def set_field(self, field, block='citation'):
+        """Adds the field or replaces the field with the same typeName."""
+        type_name = field['typeName']
+        current = self.get_field(type_name, block)
+        if current is None:
+            block_json = self.json['metadataBlocks'].setdefault(
+                block, {'displayName': block, 'fields': []}
+            )
+            block_json.setdefault('fields', []).append(field)
+            self._fields.setdefault(block, {})[type_name] = field
+        else:
+            current.clear()
+            current.update(field)
+        self._mark(type_name, block)
+        return self.get_field(type_name, block)
+
+    def set_value(self, type_name, value, block='citation'):
+        """Replaces the value of a primitive field, adds the field if needed."""
+        current = self.get_field(type_name, block)
+        if current is None:
+            return self.set_field(
+                primitive_field(type_name, value, isinstance(value, list)), block
+            )
+        current['value'] = value
+        self._mark(type_name, block)
+        return current
+
+    def set_subvalue(self, type_name, subfield, value, index=0, block='citation'):
+        """Replaces the value of a subfield of a compound field."""
+        current = self.get_field(type_name, block)
+        if current is None:
+            raise MetadataNotFoundError(
+                'Field {0} is not in the metadata.'.format(type_name)
+            )
+        compounds = current['value'] if current['multiple'] else [current['value']]
+        compound = compounds[index]
+        if subfield in compound:
+            compound[subfield]['value'] = value
+        else:
+            compound[subfield] = primitive_field(subfield, value)
+        self._mark(type_name, block)
+        return current
+
+    def add_values(self, field, block='citation'):
+        """Appends the values of a multiple field to the existing values."""
+        current = self.get_field(field['typeName'], block)
+        if current is None:
+            return self.set_field(field, block)
+        current['value'].extend(field['value'])
+        self._mark(field['typeName'], block)
+        return current
+
+    def get_changed_fields(self):
+        return [self._fields[block][type_name] for block, type_name in self._changed]
+
+    def has_changes(self):
+        return bool(self._changed)
+
+    def clear_changes(self):
+        self._changed = []
+        self._changed_keys = set()
+
+    def _mark(self, type_name, block):
+        if (block, type_name) not in self._changed_keys:
+            self._changed_keys.add((block, type_name))
+            self._changed.append((block, type_name))
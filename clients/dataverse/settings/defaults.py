@@ -36,6 +36,31 @@ SWORD_NAMESPACE = {
 
 UNIQUE_FIELDS = ['title', 'id', 'updated', 'summary']
 
+# Bytes read from disk at once when streaming uploads
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# HTTP connections kept alive per host, shared by all objects of a Connection
+POOL_SIZE = 10
+
+# Retries of idempotent requests on connection errors and RETRY_STATUS
+RETRIES = 3
+RETRY_BACKOFF = 0.5  # seconds, doubled for each retry
+RETRY_STATUS = [500, 502, 503, 504]
+
+# Seconds to wait for a connection and between bytes of a response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+
+# Seconds that service documents, collection info and contents are cached
+CACHE_TTL = 300
+
+# Concurrent uploads through the native API
+UPLOAD_WORKERS = 4
+
+# Retries of an upload while the dataset is locked, e.g. during ingest
+LOCK_RETRIES = 30
+LOCK_WAIT = 2  # seconds
+
 REPLACEMENT_DICT = {
     'id': 'identifier',
     'author': 'creator',
@@ -3,6 +3,8 @@ from __future__ import print_function, absolute_import
 import pytest
 
 import uuid
+from io import BytesIO
+from zipfile import ZipFile
 import httpretty
 import requests
 
@@ -10,7 +12,9 @@ from dataverse.connection import Connection
 from dataverse.dataset import Dataset
 from dataverse.settings import TEST_HOST
 from dataverse.test.config import PICS_OF_CATS_DATASET, ATOM_DATASET, EXAMPLE_FILES
+from dataverse import cache
 from dataverse import exceptions
+from dataverse import metadata
 from dataverse import utils
 
 import logging
@@ -102,6 +106,97 @@ class TestUtils(object):
         formatted_term = utils.format_term('id', namespace='dcterms')
         assert formatted_term == '{http://purl.org/dc/terms/}identifier'
 
+    def test_get_xpath_memoized(self):
+        xpath = utils.get_xpath('link', 'http://www.w3.org/2005/Atom', 'rel', 'edit')
+        assert xpath is utils.get_xpath(
+            'link', 'http://www.w3.org/2005/Atom', 'rel', 'edit'
+        )
+
+    def test_iter_entries(self):
+        feed = (
+            b'<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed</title>'
+            b'<entry><title>First</title></entry>'
+            b'<entry><title>Second</title></entry></feed>'
+        )
+        titles = [utils.get_element(entry, 'title').text
+                  for entry in utils.iter_entries(feed)]
+        assert titles == ['First', 'Second']
+
+    def test_iter_zip(self):
+        arcnames = ['files/{0}'.format(i) for i in range(len(EXAMPLE_FILES))]
+        content = b''.join(utils.iter_zip(EXAMPLE_FILES, arcnames, chunk_size=64))
+
+        zip_file = ZipFile(BytesIO(content))
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == arcnames
+        for filepath, arcname in zip(EXAMPLE_FILES, arcnames):
+            with open(filepath, 'rb') as f:
+                assert zip_file.read(arcname) == f.read()
+
+    def test_iter_zip_size_limit(self, monkeypatch):
+        monkeypatch.setattr(utils, 'ZIP_MAX_SIZE', 100)
+        # Raised before the archive is produced
+        with pytest.raises(exceptions.OperationFailedError):
+            utils.iter_zip(EXAMPLE_FILES)
+
+
+class TestCache(object):
+
+    def teardown_method(self, method):
+        cache.clear()
+
+    def test_put_get(self):
+        cache.put('host', 'token', 'contents', 'alias', ['dataset'])
+        assert cache.get('host', 'token', 'contents', 'alias') == ['dataset']
+        assert cache.get('host', 'other-token', 'contents', 'alias') is None
+
+    def test_expired(self):
+        cache.put('host', 'token', 'contents', 'alias', ['dataset'], ttl=-1)
+        assert cache.get('host', 'token', 'contents', 'alias') is None
+
+    def test_invalidate(self):
+        cache.put('host', 'token', 'contents', 'alias', ['dataset'])
+        cache.put('host', 'other-token', 'contents', 'alias', ['dataset'])
+        cache.put('host', 'token', 'service-document', value='document')
+        cache.invalidate('host', name='alias')
+
+        assert cache.get('host', 'token', 'contents', 'alias') is None
+        assert cache.get('host', 'other-token', 'contents', 'alias') is None
+        assert cache.get('host', 'token', 'service-document') == 'document'
+
+
+class TestMetadata(object):
+
+    def setup_method(self, method):
+        self.version = {'metadataBlocks': {'citation': {'fields': [
+            metadata.primitive_field('title', 'Title'),
+            metadata.compound_field('author', [{'authorName': 'Bull, Peter'}]),
+        ]}}}
+        self.metadata = metadata.DatasetMetadata(self.version)
+
+    def test_get_field(self):
+        assert self.metadata.get_value('title') == 'Title'
+        assert self.metadata.get_field('nonsense') is None
+        assert not self.metadata.has_changes()
+
+    def test_update_in_place(self):
+        self.metadata.set_subvalue('author', 'authorName', 'Cat, Felix')
+        fields = self.version['metadataBlocks']['citation']['fields']
+        assert fields[1]['value'][0]['authorName']['value'] == 'Cat, Felix'
+        assert self.metadata.get_changed_fields() == [fields[1]]
+
+    def test_add_values(self):
+        self.metadata.add_values(
+            metadata.compound_field('otherId', [{'otherIdValue': 'a'}])
+        )
+        self.metadata.add_values(
+            metadata.compound_field('otherId', [{'otherIdValue': 'b'}])
+        )
+        values = self.metadata.get_value('otherId')
+        assert [v['otherIdValue']['value'] for v in values] == ['a', 'b']
+        assert len(self.version['metadataBlocks']['citation']['fields']) == 3
+        assert len(self.metadata.get_changed_fields()) == 1
+
 
 class TestConnection(DataverseServerTestBase):
 
@@ -126,6 +221,8 @@ class TestConnection(DataverseServerTestBase):
             status=400,
         )
 
+        # Do not use the service document of earlier connections
+        cache.clear()
         with pytest.raises(exceptions.ConnectionError):
             Connection(TEST_HOST, self.token)
 
@@ -235,6 +332,54 @@ class TestDataset(object):
                             'http://creativecommons.org/licenses/by/3.0/'
 
 
+class LocalConnection(object):
+    native_base_url = 'http://dataverse.example.com/api'
+    token = 'token'
+    session = requests.Session()
+
+
+class LocalDataverse(object):
+    connection = LocalConnection()
+
+
+class TestDatasetLock(object):
+
+    def setup_method(self, method):
+        self.dataset = Dataset(title='Locked', dataverse=LocalDataverse())
+        self.dataset._id = 1
+        self.locks_url = 'http://dataverse.example.com/api/datasets/1/locks'
+
+    @httpretty.activate
+    def test_locked(self):
+        httpretty.register_uri(httpretty.GET, self.locks_url,
+                               body='{"status": "OK", "data": [{"lockType": "Ingest"}]}')
+        httpretty.register_uri(httpretty.POST, 'http://dataverse.example.com/add',
+                               status=400, body='{"status": "ERROR", "message": "Failed"}')
+        resp = requests.post('http://dataverse.example.com/add')
+        assert self.dataset._is_locked(resp)
+
+    @httpretty.activate
+    def test_lock_in_message(self):
+        httpretty.register_uri(httpretty.GET, self.locks_url,
+                               body='{"status": "OK", "data": []}')
+        httpretty.register_uri(
+            httpretty.POST, 'http://dataverse.example.com/add', status=400,
+            body='{"status": "ERROR", "message": "Dataset cannot be edited due to dataset lock."}',
+        )
+        resp = requests.post('http://dataverse.example.com/add')
+        assert self.dataset._is_locked(resp)
+
+    @httpretty.activate
+    def test_not_locked(self):
+        httpretty.register_uri(httpretty.GET, self.locks_url, status=404)
+        httpretty.register_uri(
+            httpretty.POST, 'http://dataverse.example.com/add', status=400,
+            body='{"status": "ERROR", "message": "Invalid block size, check the clock."}',
+        )
+        resp = requests.post('http://dataverse.example.com/add')
+        assert not self.dataset._is_locked(resp)
+
+
 class TestDatasetOperations(DataverseServerTestBase):
 
     @classmethod
@@ -292,6 +437,11 @@ class TestDatasetOperations(DataverseServerTestBase):
         assert retrieved_dataset
         self.dataverse.delete_dataset(retrieved_dataset)
 
+    def test_get_dataset_by_id(self):
+        dataset = self.dataverse.get_dataset_by_id(self.dataset.id)
+        assert dataset.doi == self.dataset.doi
+        assert self.dataverse.get_dataset_id(self.dataset.doi) == self.dataset.id
+
     def test_add_files(self):
         self.dataset.upload_filepaths(EXAMPLE_FILES)
         actual_files = [f.name for f in self.dataset.get_files()]
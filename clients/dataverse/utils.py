@@ -1,11 +1,26 @@
 from __future__ import absolute_import
 
 import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from io import BytesIO
 
 from lxml import etree
 import bleach
 
-from dataverse.settings import SWORD_NAMESPACE, REPLACEMENT_DICT, UNIQUE_FIELDS
+from dataverse.exceptions import OperationFailedError
+from dataverse.settings import (
+    SWORD_NAMESPACE, REPLACEMENT_DICT, UNIQUE_FIELDS, UPLOAD_CHUNK_SIZE,
+)
+
+ZIP_MAX_SIZE = 0xFFFFFFFF  # no zip64 support
+ZIP_MAX_ENTRIES = 0xFFFF
+
+# Compiled paths per thread, lxml XPath objects must not be shared between threads
+_xpaths = threading.local()
 
 
 # factor out xpath operations so we don't have to look at its ugliness
@@ -17,11 +32,24 @@ def get_element(root, tag='*', namespace=None, attribute=None, attribute_value=N
 def get_elements(root, tag='*', namespace=None, attribute=None, attribute_value=None):
 
     # If string, convert to etree element
+    # Callers that query a document repeatedly should keep the parsed element
     if isinstance(root, (str, bytes)):
         root = etree.XML(root)
 
     namespace = root.nsmap.get(namespace, namespace)
 
+    return get_xpath(tag, namespace, attribute, attribute_value)(root)
+
+
+def get_xpath(tag='*', namespace=None, attribute=None, attribute_value=None):
+    """Returns the compiled path to the child elements, memoized per thread."""
+    key = (tag, namespace, attribute, attribute_value)
+    cache = getattr(_xpaths, 'cache', None)
+    if cache is None:
+        cache = _xpaths.cache = {}
+    if key in cache:
+        return cache[key]
+
     if namespace is None:
         xpath = tag
     else:
@@ -34,7 +62,22 @@ def get_elements(root, tag='*', namespace=None, attribute=None, attribute_value=
     elif attribute and attribute_value:
         xpath += "[@{att}='{val}']".format(att=attribute, val=attribute_value)
 
-    return root.findall(xpath)
+    cache[key] = etree.ETXPath(xpath)
+    return cache[key]
+
+
+def iter_entries(feed):
+    """Yields the atom entries of a feed while it is parsed.
+
+    Entries are released after use, do not keep references to them.
+    """
+    for _, entry in etree.iterparse(BytesIO(feed), tag='{*}entry'):
+        if entry.getparent() is None or entry.getparent().getparent() is not None:
+            continue  # only entries of the feed itself
+        yield entry
+        entry.clear()
+        while entry.getprevious() is not None:
+            del entry.getparent()[0]
 
 
 def format_term(term, namespace):
@@ -98,5 +141,145 @@ def get_files_in_path(path):
     return filepaths
 
 
+def deflate_bound(size):
+    """Returns the largest possible deflated size, as zlib's compressBound."""
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def iter_zip(filepaths, arcnames=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Returns an iterator over a zip archive of the files piece by piece.
+
+    Entries are deflated and followed by a data descriptor, so the archive is
+    produced without holding it or any of the files in memory. The archive
+    size is checked against the zip limits before anything is produced.
+
+    :param list filepaths: files to archive
+    :param list arcnames: names in the archive, defaults to the file paths
+    :raises OperationFailedError: if the archive may exceed the zip limits
+    """
+    if arcnames is None:
+        arcnames = [os.path.splitdrive(path)[1].lstrip(os.sep) for path in filepaths]
+    names = []
+    for arcname in arcnames:
+        name = arcname.replace(os.sep, '/')
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        names.append(name)
+
+    if len(names) > ZIP_MAX_ENTRIES:
+        raise OperationFailedError('Upload exceeds the zip entry limit.')
+    # Offsets of the entries and of the central directory must fit as well
+    offset = 0
+    for filepath, name in zip(filepaths, names):
+        size = os.path.getsize(filepath)
+        offset += 30 + len(name) + deflate_bound(size) + 16
+        if size > ZIP_MAX_SIZE or offset > ZIP_MAX_SIZE:
+            raise OperationFailedError(
+                'Upload of {0} exceeds the zip size limit.'.format(filepath)
+            )
+
+    return _iter_zip(filepaths, names, chunk_size)
+
+
+def _iter_zip(filepaths, names, chunk_size):
+    offset = 0
+    central_directory = []
+    for filepath, name in zip(filepaths, names):
+        mtime = time.localtime(os.path.getmtime(filepath))
+        dos_time = mtime.tm_hour << 11 | mtime.tm_min << 5 | mtime.tm_sec // 2
+        dos_date = (mtime.tm_year - 1980) << 9 | mtime.tm_mon << 5 | mtime.tm_mday
+        flags = 0x08 | 0x800  # data descriptor, utf-8 name
+
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, 8, dos_time,
+                             dos_date, 0, 0, 0, len(name), 0) + name
+        yield header
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data = compressor.compress(chunk)
+                compressed_size += len(data)
+                if data:
+                    yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield data
+        crc &= 0xFFFFFFFF
+
+        yield struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+
+        central_directory.append(
+            struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, 8,
+                        dos_time, dos_date, crc, compressed_size, size,
+                        len(name), 0, 0, 0, 0, 0o644 << 16, offset) + name
+        )
+        offset += len(header) + compressed_size + 16
+
+    directory = b''.join(central_directory)
+    yield directory
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(central_directory),
+                      len(central_directory), len(directory), offset, 0)
+
+
+def multipart_file(filepath, filename, fields=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Returns a multipart/form-data body with a file and form fields.
+
+    The body is a file-like object that streams the file from disk.
+
+    :param dict fields: additional form fields, name -> string value
+    :return: (body, content type)
+    """
+    boundary = uuid.uuid4().hex
+    preamble = b''
+    for key, value in (fields or {}).items():
+        preamble += (
+            '--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n'
+            '{2}\r\n'.format(boundary, key, value)
+        ).encode('utf-8')
+    preamble += (
+        '--{0}\r\nContent-Disposition: form-data; name="file"; filename="{1}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, filename)
+    ).encode('utf-8')
+    epilogue = '\r\n--{0}--\r\n'.format(boundary).encode('utf-8')
+
+    def parts():
+        yield preamble
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+        yield epilogue
+
+    length = len(preamble) + os.path.getsize(filepath) + len(epilogue)
+    content_type = 'multipart/form-data; boundary={0}'.format(boundary)
+    return IterStream(parts(), length), content_type
+
+
+class IterStream(object):
+    """Read-only file-like object over an iterator of byte strings.
+
+    requests sends it with the given length as Content-Length.
+    """
+    def __init__(self, iterator, length):
+        self.iterator = iterator
+        self.len = length
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self.iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
 def sanitize(value):
     return bleach.clean(value, strip=True, tags=[], attributes=[], styles=[])
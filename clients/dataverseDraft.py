@@ -11,6 +11,8 @@ import os
 from dataverse import Connection
 from dataverse.dataverse import Dataverse
 from dataverse.dataset import Dataset
+from dataverse.exceptions import OperationFailedError
+from dataverse.metadata import DatasetMetadata, primitive_field, compound_field
 
 class dataverseDraft():
 
@@ -20,6 +22,7 @@ class dataverseDraft():
         self.alias  	= alias
         self.draftUrl   = draftUrl
         self.__dataset	= None
+        self.__staged   = None
         self.repoName   = 'Dataverse'
         self.metaKeys   = ['TITLE', 'ABSTRACT', 'CREATOR', 'SUBJECT']
 
@@ -49,6 +52,16 @@ class dataverseDraft():
         except:
             return ["Draft not created."] 
 
+    def attach(self, draftUrl):
+        '''
+        Continue working on an existing draft.
+        '''
+        connection = Connection(self.apiUrl, self.apiToken, use_https=False)
+        dataverse = connection.get_dataverse(self.alias)
+        self.__dataset = dataverse.get_dataset_by_doi(draftUrl.split('persistentId=')[1])
+        self.__md = self.__dataset.get_metadata()
+        self.draftUrl = draftUrl
+
     def patchGeneral(self, metadata, collPath = 'irods'):
         '''
         Adds and updates metadata to a Datacite draft.
@@ -56,134 +69,144 @@ class dataverseDraft():
         If data is not uploaded it is advised to provide pids pointing to the data in iRODS or
         to provide tickets for anonym ous data download.
         NOTE: If the draft already contains files, the update of metadata will fail.
+        The changes are staged and written with commit().
         Parameters:
         metadata = ipc.mdGet()
         collPath = iRODS path
         '''
-        errorMsg = []
-        curMeta = self.__dataset.get_metadata('latest')
-
-        # CREATOR --> author
-        old = self.search('author', curMeta['metadataBlocks']['citation']['fields'])
-        new = old.copy()
-        new['value'][0]['authorName']['value'] = metadata['CREATOR']
-        idx = curMeta['metadataBlocks']['citation']['fields'].index(old)
-        curMeta['metadataBlocks']['citation']['fields'][idx] = new
-
-        # ABSTRACT --> dsDescription
-        old = self.search('dsDescription', curMeta['metadataBlocks']['citation']['fields'])
-        new = old.copy()
-        new['value'][0]['dsDescriptionValue']['value'] = metadata['ABSTRACT']
-        idx = curMeta['metadataBlocks']['citation']['fields'].index(old)
-        curMeta['metadataBlocks']['citation']['fields'][idx] = new
-
-        # TECHNICALINFO --> dataSources; new metadata
+        try:
+            curMeta = self.staged()
+            # CREATOR --> author
+            curMeta.set_subvalue('author', 'authorName', metadata['CREATOR'])
+            # ABSTRACT --> dsDescription
+            curMeta.set_subvalue('dsDescription', 'dsDescriptionValue', metadata['ABSTRACT'])
+        except Exception:
+            return ['Dataverse PUBLISH ERROR: Draft not patched with with new metadata: CREATOR, ABSTRACT, TECHNICALINFO, OTHER, PID or TICKET.']
+
+        # TECHNICALINFO --> dataSources
         if 'TECHNICALINFO' in metadata:
-            new = {u'multiple': True,
-               u'typeClass': u'primitive',
-               u'typeName': u'dataSources',
-               u'value': [u'Data source']}
-            new['value'][0] = metadata['TECHNICALINFO']
-            curMeta['metadataBlocks']['citation']['fields'].append(new)
-      
+            curMeta.add_values(primitive_field('dataSources', [metadata['TECHNICALINFO']], True))
         # OTHER --> alternativeURL
         if 'OTHER' in metadata:
-            new = {u'multiple': False,
-               u'typeClass': u'primitive',
-               u'typeName': u'alternativeURL',
-               u'value': u'http://myalturi.nl'}
-            new['value'] = metadata['OTHER']
-            curMeta['metadataBlocks']['citation']['fields'].append(new)
+            curMeta.set_value('alternativeURL', metadata['OTHER'])
 
         # collection iRODS path, PID and ticket --> otherId
-        new = self.addAltID('iRODS', collPath)
-        curMeta['metadataBlocks']['citation']['fields'].append(new)
-
+        altIDs = [('iRODS', collPath)]
         if 'PID' in metadata:
-            new = self.addAltID('Handle', 'hdl.handle.net/'+metadata['PID'])
-            curMeta['metadataBlocks']['citation']['fields'].append(new)
-
+            altIDs.append(('Handle', 'hdl.handle.net/'+metadata['PID']))
         if 'TICKET' in metadata:
-            new = self.addAltID('iRODS ticket', metadata['TICKET'])
-            curMeta['metadataBlocks']['citation']['fields'].append(new)
- 
-        try:
-            self.__dataset.update_metadata(curMeta)
-            errorMsg.append('Dataverse PUBLISH INFO: Draft patched')
-        except:
-            errorMsg.append('Dataverse PUBLISH ERROR: Draft not patched with with new metadata: CREATOR, ABSTRACT, TECHNICALINFO, OTHER, PID or TICKET.')        
-        return errorMsg
+            altIDs.append(('iRODS ticket', metadata['TICKET']))
+        curMeta.add_values(self.addAltIDs(altIDs))
+
+        return []
+
+    def patchTickets(self, tickets):
+        '''
+        Patches a draft with tickets as otherReferences, staged for commit().
+        Expects a dictionary irods obj path --> ticket
+        '''
+        return self.patchRefs(tickets, 'Ticket: ')
+
+    def patchPIDs(self, pids):
+        '''
+        Patches a draft with PIDs as otherReferences, staged for commit().
+        Expects a dictionary irods obj path --> pid
+        '''
+        return self.patchRefs(pids)
 
     def patchRefs(self, refs, prefix = 'hdl.handle.net/'):
         '''
         Patches a draft with tickets and pids for data objects as otherReferences.
         Expects a dictionary irods obj path --> ticket
+        The changes are staged and written with commit().
         '''
-        errorMsg = []
-        curMeta = self.__dataset.get_metadata('latest')
-        new = {u'multiple': True,
-               u'typeClass': u'primitive',
-               u'typeName': u'otherReferences',
-               u'value': [u'Reference1', u'Reference2']}
-        new['value'] = [os.path.basename(ref)+': '+prefix+refs[ref] for ref in refs]
-        curMeta['metadataBlocks']['citation']['fields'].append(new)
+        try:
+            curMeta = self.staged()
+        except Exception:
+            return ['Dataverse PUBLISH ERROR: Draft not patched with data references.']
+        curMeta.add_values(self.addReferences(dict((ref, prefix+refs[ref]) for ref in refs)))
+
+        return []
+
+    def staged(self):
+        '''
+        Returns the metadata document (DatasetMetadata) that collects all patches until commit().
+        '''
+        if self.__staged is None:
+            self.__staged = DatasetMetadata(self.__dataset.get_metadata('latest'))
+        return self.__staged
 
+    def commit(self):
+        '''
+        Writes all staged patches to the draft in one request.
+        Only the changed fields are sent, Dataverse installations without the editMetadata
+        API get the whole document.
+        '''
+        if self.__staged is None or not self.__staged.has_changes():
+            return []
         try:
-            self.__dataset.update_metadata(curMeta)
-            errorMsg.append('Dataverse PUBLISH INFO: Draft patched with refs: '+str(refs))
+            try:
+                self.__dataset.edit_metadata(self.__staged.get_changed_fields())
+            except OperationFailedError:
+                self.__dataset.update_metadata(self.__staged.json)
         except:
-            errorMsg.append('Dataverse PUBLISH ERROR: Draft not patched with data references.')
-        return errorMsg
+            return ['Dataverse PUBLISH ERROR: Draft not patched with new metadata: ' +
+                ', '.join([field['typeName'] for field in self.__staged.get_changed_fields()])]
+        # later patches start from the written version
+        self.__staged = None
+        return ['Dataverse PUBLISH INFO: Draft patched']
 
-    def uploadData(self, folder):
+    def uploadData(self, folder, descriptions = {}, native = True, workers = 4):
         '''
-        Uploads local files from a folder to the draft.
+        Uploads local files from a folder and its subfolders to the draft.
+        Files are stored under their path relative to folder.
+        Files which are already in the draft are skipped, a failed upload can be repeated.
+        Files are streamed from disk, with native (default) each file separately and
+        workers files concurrently, otherwise all files as one zip.
+        descriptions - dictionary path relative to folder --> file description (native only)
         '''
         errorMsg = []
 
-        uploadFiles = [folder +'/'+ fname for fname in os.listdir(folder)]
+        uploaded = set(f.path for f in self.__dataset.get_files('latest'))
+        uploadFiles = [os.path.join(root, name) for root, dirs, names in os.walk(folder)
+                       for name in names
+                       if os.path.relpath(os.path.join(root, name), folder).replace(os.sep, '/')
+                       not in uploaded]
+        if uploadFiles == []:
+            return ['Dataverse PUBLISH: Files already uploaded']
         try:
-            self.__dataset.upload_filepaths(uploadFiles)
+            self.__dataset.upload_filepaths(uploadFiles, root = folder, native = native,
+                descriptions = descriptions, workers = workers)
             errorMsg.append('Dataverse PUBLISH: Files uploaded')
+        except OperationFailedError as e:
+            errorMsg.append('Dataverse PUBLISH ERROR: ' + str(e))
         except:
-             errorMsg.append('Dataverse PUBLISH ERROR: Files not uploaded ')
+            errorMsg.append('Dataverse PUBLISH ERROR: Files not uploaded ')
         return errorMsg
 
     def getDOI(self):
         return self.__dataset.doi
 
     def search(self, keyword, mdDictList):
-        entries =  (element for element in mdDictList if element['typeName'] == keyword)
-        try:
-            entry = entries.next()
-            return entry
-        except:
+        entry = DatasetMetadata({'metadataBlocks': {'citation': {'fields': mdDictList}}}
+            ).get_field(keyword)
+        if entry is None:
             print keyword, 'does not exist in list.'
-            return None
+        return entry
 
     def addAltID(self, IdAgency, IdValue):
-        new = {u'multiple': True,
-               u'typeClass': u'compound',
-               u'typeName': u'otherId',
-               u'value': [{u'otherIdAgency': {u'multiple': False,
-               u'typeClass': u'primitive',
-               u'typeName': u'otherIdAgency',
-               u'value': u'Agency'},
-               u'otherIdValue': {u'multiple': False,
-               u'typeClass': u'primitive',
-               u'typeName': u'otherIdValue',
-               u'value': u'ID'}}]}
-        new['value'][0]['otherIdAgency']['value'] = IdAgency
-        new['value'][0]['otherIdValue']['value'] = IdValue
-        return new
+        return self.addAltIDs([(IdAgency, IdValue)])
+
+    def addAltIDs(self, altIDs):
+        '''
+        altIDs: list of (agency, value) tuples.
+        '''
+        return compound_field('otherId',
+            [{'otherIdAgency': agency, 'otherIdValue': value} for agency, value in altIDs])
 
     def addReferences(self, refs):
         '''
         refs: Dictionary of path:pid or path:ticket.
         '''
-        new = {u'multiple': True,
-               u'typeClass': u'primitive',
-               u'typeName': u'otherReferences',
-               u'value': [u'Reference1', u'Reference2']}
-        new['value'] = [os.path.basename(ref)+': '+refs[ref] for ref in refs]
-        return new
+        return primitive_field('otherReferences',
+            [os.path.basename(ref)+': '+refs[ref] for ref in refs], True)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+@licence: Apache 2.0
+@Copyright (c) 2018, Christine Staiger (SURFsara)
+@author: Christine Staiger
+"""
+
+import re
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+POOLSIZE    = 20   # connections kept alive per host
+RETRIES     = 5    # retries for 429 and 5xx responses and failed connections
+BACKOFF     = 0.5  # seconds, doubled for each retry
+RETRYSTATUS = [429, 500, 502, 503, 504]
+RETRYMETHODS = ['GET', 'HEAD', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+
+_sessions = {}
+_lock = threading.Lock()
+
+def getSession(name, poolSize = POOLSIZE, retries = RETRIES, backoff = BACKOFF,
+               methods = RETRYMETHODS):
+    '''
+    Returns the requests.Session registered under name, creates it on first use.
+    All clients of one repository share a session, hence connections are kept alive
+    and reused across drafts in the same process.
+    poolSize - number of connections kept alive per host
+    retries  - number of retries for connection errors and responses with RETRYSTATUS
+    backoff  - backoff factor for the retries in seconds
+    methods  - HTTP methods that are retried; POST is not retried, it may create duplicates
+    '''
+    with _lock:
+        if name not in _sessions:
+            retry = Retry(total = retries, backoff_factor = backoff,
+                status_forcelist = RETRYSTATUS, method_whitelist = frozenset(methods),
+                raise_on_status = False)
+            adapter = HTTPAdapter(pool_connections = poolSize, pool_maxsize = poolSize,
+                max_retries = retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[name] = session
+
+    return _sessions[name]
+
+def closeSession(name):
+    '''
+    Closes the session registered under name, a new one is created on next use.
+    '''
+    with _lock:
+        session = _sessions.pop(name, None)
+    if session is not None:
+        session.close()
+
+def publicUrl(url):
+    '''
+    Removes the access_token parameter from url. Draft urls are stored in iRODS metadata,
+    journals and reports, which must not contain API tokens.
+    '''
+    return re.sub(r'([?&])access_token=[^&#]*&?', r'\1', url).rstrip('?&')
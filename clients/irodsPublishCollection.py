@@ -8,11 +8,28 @@
 #iRODS imports
 from irods.session import iRODSSession
 from irods.access import iRODSAccess
+from irods.models import Collection, CollectionAccess, DataObject, DataObjectMeta, DataAccess, User
+from irods.column import Like
+from irods.meta import iRODSMeta
 import irods.keywords as kw
+try:
+    from irods.meta import AVUOperation
+except ImportError:
+    #python-irodsclient < 0.8.3, no atomic metadata operations
+    AVUOperation = None
+try:
+    from irods.column import In
+except ImportError:
+    #older python-irodsclient, one query per key
+    In = None
 
 #iRODS tickets
+from irods.ticket import Ticket
 import subprocess
 
+#Concurrent iRODS calls
+from multiprocessing.pool import ThreadPool
+
 #File and password handling
 import os
 import shutil
@@ -21,8 +38,14 @@ import getpass
 #PID imports
 import uuid
 
+CHUNKSIZE = 100 # number of data objects handed to a worker at once
+
+#iRODSAccess access names as reported by the iCAT
+ACCESSNAMES = {'read': 'read object', 'write': 'modify object', 'own': 'own', 'null': None}
+
 class irodsPublishCollection():
-    def __init__(self, envFile, collPath, host='ibridges', user='data', zone='myZone', httpEndpoint=''):
+    def __init__(self, envFile, collPath, host='ibridges', user='data', zone='myZone', httpEndpoint='',
+                 workers=4):
         if envFile == '':
             #workaround for testing and when icommands not available
             print 'irods ', host, 'user ', user, 'zone', zone
@@ -32,160 +55,382 @@ class irodsPublishCollection():
         else:
             self.session = iRODSSession(irods_env_file=envFile)
         self.coll   = self.session.collections.get(collPath)
-        self.mdUpdate('SERIESINFORMATION', 'iRODS Collection '+ self.coll.path)
         self.md     = self.mdGet()
+        self.mdUpdate('SERIESINFORMATION', 'iRODS Collection '+ self.coll.path)
+        self.flush()
         self.http   = httpEndpoint # http or davrods endpoint
+        self.workers = workers # number of concurrent iRODS calls for operations on all members
 
-    def size(self):
-        size = sum([obj.size for obj in self.coll.data_objects])
-        return size
+    def _pmap(self, func, items):
+        '''
+        Applies func to all items on a pool of self.workers threads and yields the results
+        in completion order. The iRODS session hands out one pooled connection per concurrent call.
+        '''
+        if self.workers < 2:
+            for item in items:
+                yield func(item)
+            return
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(func, items, CHUNKSIZE):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def members(self):
+        '''
+        Walks the collection tree lazily and yields all data objects in the collection
+        and its subcollections.
+        '''
+        for coll, subcolls, objs in self.coll.walk():
+            for obj in objs:
+                yield obj
+
+    def relPath(self, path):
+        '''
+        Returns the path of a member relative to the collection.
+        '''
+        return path[len(self.coll.path)+1:]
+
+    def inTree(self, collPath):
+        '''
+        Checks whether collPath is the collection or one of its subcollections.
+        Needed after LIKE queries, '_' and '%' in the collection path are wildcards there.
+        '''
+        return collPath == self.coll.path or collPath.startswith(self.coll.path + '/')
+
+    def _treeQuery(self, columns, criteria = []):
+        '''
+        Queries columns for the collection and all its subcollections.
+        Yields the result rows, Collection.name is always part of the row.
+        '''
+        for scope in [Collection.name == self.coll.path,
+                      Like(Collection.name, self.coll.path + '/%')]:
+            query = self.session.query(Collection.name, *columns).filter(scope, *criteria)
+            for row in query:
+                if self.inTree(row[Collection.name]):
+                    yield row
+
+    def size(self, recursive = True):
+        '''
+        Size of the collection in bytes, computed by the iCAT (see stats).
+        '''
+        return self.stats(recursive)['size']
+
+    def stats(self, recursive = True):
+        '''
+        Computes total size, number of data objects and size of the largest data object
+        with aggregate queries in the iCAT. Each data object is counted once, by its
+        replica 0, as the sizes of replicas are equal.
+        recursive - include the data objects in the subcollections.
+        Returns a dictionary with the keys size, count and max (sizes in bytes).
+        '''
+        scopes = [Collection.name == self.coll.path]
+        if recursive:
+            scopes.append(Like(Collection.name, self.coll.path + '/%'))
+
+        stats = {'size': 0, 'count': 0, 'max': 0}
+        for scope in scopes:
+            #aggregates are grouped per collection to drop collections matched by LIKE wildcards
+            #each aggregate needs its own column, the size column cannot be summed and maxed at once
+            query = self.session.query(Collection.name, DataObject.id, DataObject.size).filter(
+                scope, DataObject.replica_number == 0)
+            for row in query.count(DataObject.id).sum(DataObject.size).all():
+                if self.inTree(row[Collection.name]):
+                    stats['count'] += int(row[DataObject.id] or 0)
+                    stats['size'] += int(row[DataObject.size] or 0)
+            query = self.session.query(Collection.name, DataObject.size).filter(
+                scope, DataObject.replica_number == 0)
+            for row in query.max(DataObject.size).all():
+                if self.inTree(row[Collection.name]):
+                    stats['max'] = max(stats['max'], int(row[DataObject.size] or 0))
+
+        return stats
 
     def validate(self, repoKeys = []):
         '''
-        Checks whether collection is not empty and is not a nested collection.
+        Checks whether collection is not empty.
         repoKeys is a set of keys in te iRODS metadata that indicate, when present,
         that the data have already been published.
         '''
         errorMsg = []
-        if self.coll.subcollections != []:
-            errorMsg.append('PUBLISH ERROR: Collection contains subcollections.')
-        if self.coll.data_objects == []:
+        if next(self.members(), None) is None:
             errorMsg.append('PUBLISH ERROR: Collection does not contain data.')
-        if len(set(self.coll.metadata.keys()).intersection(repoKeys)) > 0:
+        if len(set(self.md.keys()).intersection(repoKeys)) > 0:
             errorMsg.append('PUBLISH ERROR: Data is already published.')
-            for item in self.coll.metadata.items():
-                errorMsg.append(item.name+': '+item.value)
+            for key in self.md:
+                errorMsg.append(key+': '+self.md[key])
 
         return errorMsg
 
-    def assignTicket(self, all = True):
+    def assignTicket(self, all = True, backend = 'api', existing = {}):
         '''
-        Creates irods tickets for anonymous read access for the collection.
+        Creates irods tickets for anonymous read access for the collection and all its members.
         Ticket can be used in metalnx or wth the icommands to download data.
         It also creates a metadata entry for the ticket in the metadata of the respective
         data object or collection to avoid long searches through the iCAT.
-        Note: Not yet available in python client (v0.8), hence icommands wrapper!
+        Tickets for the data objects are created concurrently (see self.workers).
+        backend - 'api': python-irodsclient ticket API over the existing session
+                  'icommands': iticket wrapper, requires icommands
+        existing - dictionary iRODS path --> ticket (see getMDall), only members without
+                   a ticket get one, e.g. after a partly failed run.
         Returns a dictionary mapping from iRODS paths to tickets.
-        Requires icommands!
         '''
-        tickets = {}
+        tickets = dict(existing)
         errorMsg = []
 
-        #iticket create read <obj path>
-        #imeta add <obj path> TICKET <ticket>
+        if self.coll.path not in tickets:
+            ticket, error = self.createTicket(self.coll.path, backend)
+            if error:
+                errorMsg.append(error)
+                return tickets, errorMsg
+            self.mdUpdate('TICKET', ticket)
+            tickets[self.coll.path] = ticket
+        if 'TECHNICALINFO' not in self.md:
+            self.mdUpdate('TECHNICALINFO', '{"irods_host": "'+self.session.host \
+                + '", "irods_port": 1247, "irods_user_name": "anonymous", "irods_zone_name": "' \
+                + self.session.zone+ '"}; iget/ils -t <ticket> ' + self.coll.path )
+        self.flush()
 
-        cmd = 'iticket create read ' + self.coll.path
-        p = subprocess.Popen([cmd], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = p.communicate()
-        if out == '':
-            errorMsg.append('TICKET ERROR: No ticket created '+ err)
+        if not all:
             return tickets, errorMsg
 
-        msg = self.mdUpdate('TICKET', out.split(':')[1].strip())
-        tickets[self.coll.path] = out.split(':')[1].strip()
-        self.mdUpdate('TECHNICALINFO', '{"irods_host": "'+self.session.host \
-            + '", "irods_port": 1247, "irods_user_name": "anonymous", "irods_zone_name": "' \
-            + self.session.zone+ '"}; iget/ils -t <ticket> ' + self.coll.path )
+        def ticketObject(obj):
+            ticket, error = self.createTicket(obj.path, backend)
+            if not error:
+                obj.metadata.add('TICKET', ticket)
+            return obj.path, ticket, error
 
-        if not all:
-            return tickets, errorMsg
+        todo = (obj for obj in self.members() if obj.path not in tickets)
+        for path, ticket, error in self._pmap(ticketObject, todo):
+            if error:
+                errorMsg.append(error)
+            else:
+                tickets[path] = ticket
+        self.flush()
+
+        return tickets, errorMsg
 
-        for obj in self.coll.data_objects:
-            cmd = 'iticket create read ' + obj.path
+    def createTicket(self, path, backend = 'api'):
+        '''
+        Creates a read ticket for an iRODS path.
+        Returns the ticket string and an error message (empty on success).
+        '''
+        if backend == 'icommands':
+            #iticket create read <obj path>
+            cmd = 'iticket create read ' + path
             p = subprocess.Popen([cmd], shell=True, stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE)
             out, err = p.communicate()
             if out == '':
-                errorMsg.append('TICKET ERROR: No ticket created '+ err)
-                return tickets, errorMsg
-            obj.metadata.add('TICKET', out.split(':')[1].strip())
-            tickets[obj.path] = out.split(':')[1].strip()
+                return '', 'TICKET ERROR: No ticket created '+ err
+            return out.split(':')[1].strip(), ''
 
-        return tickets, errorMsg
+        try:
+            ticket = Ticket(self.session)
+            ticket.issue('read', path)
+        except Exception as e:
+            return '', 'TICKET ERROR: No ticket created ' + path + ' ' + repr(e)
+        return ticket.ticket, ''
 
-    def assignPID(self, pidClient, all = True):
+    def assignPID(self, pidClient, all = True, existing = {}):
         '''
         Creates epic PIDs for the collection and all its members.
-        Returns a dictionary mapping from iRODS paths to PIDs.
+        Returns a dictionary mapping from paths relative to the collection to PIDs,
+        the collection itself is listed with its name.
         pidCredentials - instance of B2Handle EUDATHandleClient.
+        existing - dictionary iRODS path --> PID (see getMDall), only members without
+                   a PID get one, e.g. after an interrupted run.
         '''
         pids = {}
         #TODO: mint real PIDs
-        pid = str(uuid.uuid1())
-        self.mdUpdate("PID", pid)
-        pids[self.coll.name] = pid
+        if self.coll.path in existing:
+            pids[self.coll.name] = existing[self.coll.path]
+        else:
+            pid = str(uuid.uuid1())
+            self.mdUpdate("PID", pid)
+            self.flush()
+            pids[self.coll.name] = pid
 
         if all:
-            for obj in self.coll.data_objects:
+            for obj in self.members():
+                if obj.path in existing:
+                    pids[self.relPath(obj.path)] = existing[obj.path]
+                    continue
                 pid = str(uuid.uuid1())
                 obj.metadata.add("PID", pid)
-                pids[obj.name] = pid
+                pids[self.relPath(obj.path)] = pid
 
         return pids
 
-    def close(self, owners = set()):
+    def close(self, owners = set(), recursive = False, inherit = False):
         '''
         Set permission to read only for group 'public'.
         Get list of users who created the data. The original creator of the data can be retrieved with obj.owner_name.
         Script should be executed by a service account for data publishing (role data steward).
         owners - set of all additinatiol users who have write access to the collection and data objects.
+        recursive - set the ACLs once on collection level recursively instead of per member.
+        inherit - switch on ACL inheritance, new data in the collection gets the same ACLs.
+        Only ACLs which are not yet read only are changed.
         '''
+        owners = set(owners)
+        objects = self.objectOwners()
+        owners.update(objects.values())
+        users = owners | set(['public'])
 
-        #close each data object
-        for obj in self.coll.data_objects:
-            acl = iRODSAccess('read', obj.path, 'public', self.session.zone)
-            self.session.permissions.set(acl)
-            acl = iRODSAccess('read', obj.path, obj.owner_name, self.session.zone)
-            self.session.permissions.set(acl)
-            for owner in owners:
-                acl = iRODSAccess('read', obj.path, owner, self.session.zone)
-                self.session.permissions.set(acl)
-            owners.add(obj.owner_name)
-
-        #close collection
-        acl = iRODSAccess('read', self.coll.path, 'public', self.session.zone)
-        self.session.permissions.set(acl)
-        for owner in owners:
-            acl = iRODSAccess('read', self.coll.path, owner, self.session.zone)
-            self.session.permissions.set(acl)
+        wanted = [('read', self.coll.path, user) for user in users]
+        if not recursive:
+            members = self.subcollections() + objects.keys()
+            wanted.extend([('read', path, user) for path in members for user in users])
+        self.setACLs(wanted, recursive = recursive, inherit = inherit)
 
         return owners
 
-    def open(self, owners):
+    def open(self, owners, recursive = False):
         '''
         Open collection for writing to certain iRODS users (owners).
         '''
-        for owner in owners:
-            acl = iRODSAccess('write', self.coll.path, owner, self.session.zone)
-            self.session.permissions.set(acl)
-            for obj in self.coll.data_objects:
-                acl = iRODSAccess('write', obj.path, owner, self.session.zone)
-                self.session.permissions.set(acl)
+        wanted = [('write', self.coll.path, owner) for owner in owners]
+        if not recursive:
+            members = self.subcollections() + self.objectOwners().keys()
+            wanted.extend([('write', path, owner) for path in members for owner in owners])
+        self.setACLs(wanted, recursive = recursive)
 
         return ['COLLECTION WRITE ACCESS: ' + str(owners)]
 
+    def checksums(self):
+        '''
+        Fetches the checksums of all data objects in the collection tree.
+        Returns a dictionary path relative to the collection --> checksum
+        '''
+        return dict((self.relPath(row[Collection.name] + '/' + row[DataObject.name]),
+            row[DataObject.checksum]) for row in self._treeQuery([DataObject.name, DataObject.checksum])
+            if row[DataObject.checksum])
+
+    def subcollections(self):
+        '''
+        Returns the paths of all subcollections in the collection tree.
+        '''
+        query = self.session.query(Collection.name).filter(
+            Like(Collection.name, self.coll.path + '/%'))
+        return [row[Collection.name] for row in query if self.inTree(row[Collection.name])]
+
+    def objectOwners(self):
+        '''
+        Fetches all data objects in the collection tree with their owners.
+        Returns a dictionary iRODS path --> owner name
+        '''
+        return dict((row[Collection.name] + '/' + row[DataObject.name], row[DataObject.owner_name])
+            for row in self._treeQuery([DataObject.name, DataObject.owner_name]))
+
+    def getACLs(self):
+        '''
+        Fetches the ACLs of the collection and all its members with bulk queries.
+        Returns a dictionary iRODS path --> {user name: access name}
+        '''
+        acls = {self.coll.path: {}}
+        for row in self._treeQuery([User.name, CollectionAccess.name]):
+            acls.setdefault(row[Collection.name], {})[row[User.name]] = row[CollectionAccess.name]
+
+        for row in self._treeQuery([DataObject.name, User.name, DataAccess.name]):
+            path = row[Collection.name] + '/' + row[DataObject.name]
+            acls.setdefault(path, {})[row[User.name]] = row[DataAccess.name]
+
+        return acls
+
+    def setACLs(self, wanted, recursive = False, inherit = False):
+        '''
+        Sets ACLs, wanted is an iterable of (access, iRODS path, user).
+        ACLs which are already in the wanted state are skipped, the remaining changes
+        are sent concurrently (see self.workers).
+        recursive - ACLs on collections are applied to all members of the collection.
+        Returns the list of changes that were sent.
+        '''
+        current = self.getACLs()
+        if recursive:
+            #a recursive ACL is only up to date if all members have it
+            done = lambda path, user, access: all(acls.get(user) == ACCESSNAMES[access]
+                for member, acls in current.items()
+                if member == path or member.startswith(path + '/'))
+        else:
+            done = lambda path, user, access: \
+                current.get(path, {}).get(user) == ACCESSNAMES[access]
+        changes = [(access, path, user) for access, path, user in set(wanted)
+            if not done(path, user, access)]
+
+        def setACL(change):
+            access, path, user = change
+            acl = iRODSAccess(access, path, user, self.session.zone)
+            self.session.permissions.set(acl, recursive = recursive)
+        for _ in self._pmap(setACL, changes):
+            pass
+
+        if inherit:
+            acl = iRODSAccess('inherit', self.coll.path)
+            self.session.permissions.set(acl, recursive = recursive)
+
+        return changes
+
     def mdUpdate(self, key, value):
         '''
         Update metadata of collection.
+        The change is applied to self.md immediately and written to iRODS with flush().
         '''
-        if key in self.coll.metadata.keys():
+        if key in self.md:
             print 'METADATA INFO: Collection has already metadata with key: ' + key
             print 'METADATA INFO: Update metadata entry.'
-            for item in self.coll.metadata.items():
-                if item.name == key:
-                    self.coll.metadata.remove(item)
-        self.coll.metadata.add(key, value)
-        self.md = self.mdGet()
+        self._mdPending[key] = value
+        self.md[key] = value
 
         return ['METADATA ADDED; '+key+' '+value]
 
+    def mdRemove(self, key):
+        '''
+        Remove metadata with key from the collection.
+        The change is applied to self.md immediately and written to iRODS with flush().
+        '''
+        self._mdPending[key] = None
+        self.md.pop(key, None)
+
+        return ['METADATA REMOVED; '+key]
+
+    def flush(self):
+        '''
+        Writes all pending metadata updates of the collection to iRODS in one atomic
+        metadata operation.
+        '''
+        operations = []
+        for key, value in self._mdPending.items():
+            for item in self._mdItems.get(key, []):
+                operations.append(('remove', item))
+            if value is not None:
+                operations.append(('add', iRODSMeta(key, value)))
+        if operations == []:
+            return
+
+        if AVUOperation is None:
+            for operation, item in operations:
+                getattr(self.coll.metadata, operation)(item)
+        else:
+            self.coll.metadata.apply_atomic_operations(
+                *[AVUOperation(operation=operation, avu=item) for operation, item in operations])
+
+        for key, value in self._mdPending.items():
+            self._mdItems[key] = [] if value is None else [iRODSMeta(key, value)]
+        self._mdPending = {}
+
     def mdGet(self):
         '''
         Reformatting od all metadata of the collection into a python dictionary.
+        Discards metadata updates that are not flushed yet.
         '''
         metadata = {}
+        self._mdItems = {}
+        self._mdPending = {}
         for item in self.coll.metadata.items():
             metadata[item.name] = item.value
+            self._mdItems.setdefault(item.name, []).append(item)
 
         return metadata
     
@@ -195,11 +440,28 @@ class irodsPublishCollection():
         It assumes that the key is only present once.
         Returns a dictionary iRODS path --> value
         '''
+        return dict((path, md[key]) for path, md in self.getMDbulk([key]).items())
+
+    def getMDbulk(self, keys):
+        '''
+        Fetches all metadata with one of the keys from the collection and all data objects
+        in the collection tree. The metadata of the data objects is retrieved with bulk queries.
+        It assumes that each key is only present once per member.
+        Returns a dictionary iRODS path --> {key: value}
+        '''
         metadata = {}
-        if key in self.coll.metadata.keys():
-            metadata[self.coll.path] = self.coll.metadata.get_all(key)[0].value
-        for obj in self.coll.data_objects:
-            if key in obj.metadata.keys():
-                metadata[obj.path] = obj.metadata.get_all(key)[0].value
+        collMD = dict((key, self.md[key]) for key in keys if key in self.md)
+        if collMD:
+            metadata[self.coll.path] = collMD
+
+        if In is None:
+            criteria = [DataObjectMeta.name == key for key in keys]
+        else:
+            criteria = [In(DataObjectMeta.name, list(keys))]
+        for criterion in criteria:
+            columns = [DataObject.name, DataObjectMeta.name, DataObjectMeta.value]
+            for row in self._treeQuery(columns, [criterion]):
+                path = row[Collection.name] + '/' + row[DataObject.name]
+                metadata.setdefault(path, {})[row[DataObjectMeta.name]] = row[DataObjectMeta.value]
 
         return metadata
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+@licence: Apache 2.0
+@Copyright (c) 2018, Christine Staiger (SURFsara)
+@author: Christine Staiger
+"""
+
+import json
+import os
+import threading
+
+from httpSession import publicUrl
+
+RED     = "\033[31m"
+GREEN   = "\033[92m"
+BLUE    = "\033[34m"
+DEFAULT = "\033[0m"
+
+STAGES = ['validate', 'close', 'pids', 'tickets', 'draft', 'metadata', 'data', 'publish']
+
+#workflows of one process share journal files, e.g. in batch publishing
+_journalLock = threading.Lock()
+
+class irodsPublishWorkflow():
+    '''
+    Publication of an iRODS collection as a sequence of stages.
+    The completion of each stage is checkpointed, either in the iRODS metadata of the
+    collection (key <repoName>/PUBLISH) or in a local journal file. Running the workflow
+    again skips all completed stages and continues with an existing draft.
+    '''
+
+    def __init__(self, publishclient, journal = '', owners = set(), maxDataSize = 2000, stream = False):
+        '''
+        publishclient - instance of irodsRepositoryClient
+        journal       - path to a local json journal, if empty checkpoints are stored in iRODS
+        owners        - additional users with write access to the collection
+        maxDataSize   - data is only uploaded to the repository if smaller (in MB)
+        stream        - upload data directly from iRODS without local copy
+        '''
+        self.client      = publishclient
+        self.journal     = journal
+        self.maxDataSize = maxDataSize
+        self.stream      = stream
+        self.key         = self.client.draft.repoName + '/PUBLISH'
+        self.state       = self.load()
+        self.owners      = set(self.state.get('owners', [])) | set(owners)
+        self.failed      = None
+
+        if self.state.get('draftUrl', '') != '':
+            self.client.draft.attach(self.state['draftUrl'])
+
+    def load(self):
+        '''
+        Reads the checkpoints of earlier runs.
+        '''
+        if self.journal == '':
+            return json.loads(self.client.ipc.md.get(self.key, '{}'))
+        with _journalLock:
+            if not os.path.exists(self.journal):
+                return {}
+            with open(self.journal) as f:
+                return json.load(f).get(self.journalKey(), {})
+
+    def save(self):
+        '''
+        Writes the current state as checkpoint.
+        '''
+        if self.journal == '':
+            self.client.ipc.mdUpdate(self.key, json.dumps(self.state))
+            self.client.ipc.flush()
+            return
+        #read, merge and replace under one lock, concurrent saves would lose checkpoints
+        with _journalLock:
+            journal = {}
+            if os.path.exists(self.journal):
+                with open(self.journal) as f:
+                    journal = json.load(f)
+            journal[self.journalKey()] = self.state
+            with open(self.journal + '.tmp', 'w') as f:
+                json.dump(journal, f, indent=1)
+            os.rename(self.journal + '.tmp', self.journal)
+
+    def journalKey(self):
+        return self.client.draft.repoName + ':' + self.client.ipc.coll.path
+
+    def completed(self):
+        return self.state.get('stages', [])
+
+    def run(self, until = 'publish'):
+        '''
+        Runs all stages up to and including until, skipping stages that are already completed.
+        Stops at the first stage that fails, self.failed is set to the name of that stage.
+        Returns the report messages.
+        '''
+        message = ['Upload to ' + self.client.draft.repoName, self.client.ipc.coll.path, '']
+        self.failed = None
+        for stage in STAGES[:STAGES.index(until)+1]:
+            if stage in self.completed():
+                print BLUE + 'Stage completed before: ' + stage + DEFAULT
+                message.append('PUBLISH INFO: Stage completed before: ' + stage)
+                continue
+            print GREEN + 'Stage: ' + stage + DEFAULT
+            out, ok = getattr(self, stage)()
+            if not self.checkpoint(stage, out, ok, message):
+                return message
+
+        return message
+
+    def checkpoint(self, stage, out, ok, message):
+        '''
+        Adds the output of a stage to message and checkpoints the stage if it succeeded.
+        Returns ok.
+        '''
+        message.extend(out)
+        if not ok:
+            print RED + 'Stage failed: ' + stage + DEFAULT
+            message.append('PUBLISH ERROR: Stage failed: ' + stage)
+            self.failed = stage
+            return False
+        self.state['stages'] = self.completed() + [stage]
+        self.save()
+        return True
+
+    def hasError(self, message):
+        return any('PUBLISH ERROR' in str(item) for item in message)
+
+    def validate(self):
+        message = self.client.checkCollection(pids = False, tickets = False)
+        return message, not self.hasError(message)
+
+    def close(self):
+        self.owners = self.client.ipc.close(self.owners)
+        self.state['owners'] = sorted(self.owners)
+        return ['OWNERS :' + str(self.owners)], True
+
+    def pids(self):
+        self.client.assignPIDs()
+        return ['PIDs for collection: ', str(self.client.pids)], True
+
+    def tickets(self):
+        message = self.client.assignTickets()
+        error = message != []
+        message.extend(['Tickets for collection', str(self.client.tickets)])
+        return message, not error
+
+    def draft(self):
+        draft = self.client.draft
+        out = draft.create(self.client.ipc.md['TITLE'])
+        if out != None and not any('already exists' in str(item) for item in out):
+            return out + [draft.repoName + ' PUBLISH ERROR: Draft not created.'], False
+        self.state['draftUrl'] = publicUrl(draft.draftUrl)
+        return ['Draft URL', publicUrl(draft.draftUrl), ''], True
+
+    def metadata(self):
+        message = self.client.patchMetadata()
+        return message, not self.hasError(message)
+
+    def data(self):
+        if self.client.draft.repoName == 'CKAN':
+            return ['CKAN PUBLISH INFO: metadata only'], True
+        if self.client.ipc.size() >= self.maxDataSize * 1000**2:
+            return ['PUBLISH INFO: Data too large, not uploaded'], True
+        message = self.client.uploadData(stream = self.stream)
+        return message, not self.hasError(message)
+
+    def publish(self):
+        if self.client.draft.repoName == 'B2SHARE':
+            publication = self.publishAsync()
+            publication.wait()
+            return self.publicationResult(publication)
+        message = self.client.publishDraft()
+        return message, not self.hasError(message)
+
+    def publishAsync(self):
+        '''
+        Submits a B2SHARE draft after run(until = 'data') without waiting for the DOI.
+        The submission is checkpointed, a draft submitted in an earlier run is not submitted
+        again, its record is polled instead.
+        Returns the b2sharePublication handle, see completePublish.
+        '''
+        if self.state.get('submitted', False):
+            print BLUE + 'Draft submitted before, waiting for DOI' + DEFAULT
+            return self.client.draft.publication()
+        print GREEN + 'Stage: publish (submitted)' + DEFAULT
+        publication = self.client.draft.publishAsync()
+        if publication.error is None:
+            self.state['submitted'] = True
+            self.save()
+        return publication
+
+    def publicationResult(self, publication):
+        if publication.doi is None:
+            return [publication.error], False
+        message = self.client.recordDOI(publication.doi)
+        return message, not self.hasError(message)
+
+    def completePublish(self, publication, message):
+        '''
+        Completes the publish stage once the handle of publishAsync is done.
+        Returns message extended by the output of the stage.
+        '''
+        out, ok = self.publicationResult(publication)
+        self.checkpoint('publish', out, ok, message)
+        return message
@@ -1,5 +1,12 @@
 from irods.access import iRODSAccess 
+import irods.keywords as kw
+from httpSession import publicUrl
+from multiprocessing.pool import ThreadPool
+import base64
 import datetime
+import functools
+import hashlib
+import itertools
 import shutil
 import os
 
@@ -8,6 +15,25 @@ GREEN   = "\033[92m"
 BLUE    = "\033[34m"
 DEFAULT = "\033[0m"
 
+BUFFERSIZE = 4 * 1024 * 1024 # bytes per read when streaming data out of iRODS
+PARALLELSIZE = 32 * 1024 * 1024 # objects of this size and larger use iRODS parallel transfer
+
+def checksumMatches(localPath, irodsChecksum, bufferSize = BUFFERSIZE):
+    '''
+    Compares a local file with an iRODS checksum (sha2:<base64 sha256> or md5 hex).
+    Returns False if iRODS has no checksum for the data object.
+    '''
+    if not irodsChecksum:
+        return False
+    sha2 = irodsChecksum.startswith('sha2:')
+    digest = hashlib.sha256() if sha2 else hashlib.md5()
+    with open(localPath, 'rb') as f:
+        for block in iter(functools.partial(f.read, bufferSize), ''):
+            digest.update(block)
+    if sha2:
+        return base64.b64encode(digest.digest()) == irodsChecksum[5:]
+    return digest.hexdigest() == irodsChecksum
+
 class irodsRepositoryClient():
 
     def __init__(self, ipc, draft, pidClient = ''):
@@ -16,8 +42,9 @@ class irodsRepositoryClient():
         self.ipc = ipc
         print "Publish collection: ", ipc.coll.path
         print "Draft Url: ", self.draft.draftUrl
-        self.pids = ipc.getMDall('PID')
-        self.tickets = ipc.getMDall('TICKET')
+        md = ipc.getMDbulk(['PID', 'TICKET'])
+        self.pids = dict((path, md[path]['PID']) for path in md if 'PID' in md[path])
+        self.tickets = dict((path, md[path]['TICKET']) for path in md if 'TICKET' in md[path])
         self.pidClient = pidClient
 
     def checkCollection(self, pids = True, tickets = True):
@@ -35,13 +62,13 @@ class irodsRepositoryClient():
             message.append(str(self.draft.metaKeys))
                            
         #Create PIDs, if not present
-        if pids and self.pids == {}:
-            self.pids = self.ipc.assignPID(self.pidClient)
+        if pids:
+            self.assignPIDs()
         message.extend(['PIDs for collection: ', str(self.pids)])
 
         #Create tickets for anonymous download of data from iRODS if not present
-        if tickets and self.tickets == {}: 
-            self.tickets, error = self.ipc.assignTicket()
+        if tickets:
+            error = self.assignTickets()
             if error:
                 message.extend(error)
                 print RED + 'Assigning tickets failed' + DEFAULT
@@ -49,30 +76,128 @@ class irodsRepositoryClient():
 
         return message
 
-    def localCopyData(self, path = '/tmp'):
+    def assignPIDs(self):
+        '''
+        Creates PIDs for the collection and the members which do not have a PID in iRODS yet.
+        '''
+        self.pids = self.ipc.assignPID(self.pidClient, existing = self.ipc.getMDall('PID'))
+        return self.pids
+
+    def assignTickets(self):
+        '''
+        Creates tickets for the collection and the members which do not have a ticket in iRODS yet.
+        Returns the error messages.
+        '''
+        self.tickets, error = self.ipc.assignTicket(existing = self.ipc.getMDall('TICKET'))
+        return error
+
+    def localCopyData(self, path = '/tmp', bufferSize = BUFFERSIZE, workers = None, threads = 4,
+                      progress = None):
         '''
         Makes a local copy of the data files in the iRODS collection, used to upload to repository.
+        The collection is copied to path/<repoName>/<iRODS path>, subcollections to subdirectories,
+        so collections with the same name do not share a directory.
+        Data is streamed in chunks of bufferSize bytes, memory use does not depend on the object size.
+        workers  - number of data objects downloaded concurrently, each worker takes its own
+                   connection from the session's connection pool. Default: ipc.workers
+        threads  - number of iRODS parallel transfer threads for objects >= PARALLELSIZE.
+        progress - callable(path, size, done), called when a data object is copied.
+        The local copy is kept between runs, objects whose local file matches the size and the
+        iRODS checksum of the data object are not copied again. Local files that are not in the
+        collection are removed.
         '''
 
-        path = path + "/" + self.ipc.coll.name
+        path = path + "/" + self.draft.repoName + self.ipc.coll.path
+        if workers is None:
+            workers = self.ipc.workers
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        expected = set()
+
+        def objects():
+            for coll, subcolls, objs in self.ipc.coll.walk():
+                for subcoll in subcolls:
+                    if not os.path.isdir(path + '/' + self.ipc.relPath(subcoll.path)):
+                        os.makedirs(path + '/' + self.ipc.relPath(subcoll.path))
+                for obj in objs:
+                    localPath = path + '/' + self.ipc.relPath(obj.path)
+                    expected.add(localPath)
+                    if os.path.isfile(localPath) and os.path.getsize(localPath) == obj.size and \
+                        checksumMatches(localPath, obj.checksum, bufferSize):
+                        continue
+                    yield obj
+
+        copy = functools.partial(self.copyObject, folder = path, bufferSize = bufferSize,
+                                 threads = threads)
+        if workers > 1:
+            pool = ThreadPool(workers)
+            copied = pool.imap_unordered(copy, objects())
+        else:
+            pool = None
+            copied = itertools.imap(copy, objects())
+
         try:
-            shutil.rmtree(path)
-        except OSError:
-            print path, "does not exist."
-                           
-        os.makedirs(path)
+            for done, obj in enumerate(copied, 1):
+                if progress:
+                    progress(obj.path, obj.size, done)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
-        for obj in self.ipc.coll.data_objects:
-            buff = self.ipc.session.data_objects.open(obj.path, 'r').read()
-            with open(path+'/'+obj.name, 'wb') as f:
-                f.write(buff)
+        #remove leftovers of earlier runs
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                if os.path.join(root, name) not in expected:
+                    os.remove(os.path.join(root, name))
 
         return path
 
-    def uploadToRepo(self, data=True):
+    def copyObject(self, obj, folder, bufferSize = BUFFERSIZE, threads = 4):
+        '''
+        Copies one data object to its relative path in folder. Large objects are fetched with
+        iRODS parallel transfer, small objects are streamed over a pooled connection.
+        '''
+        localPath = folder + '/' + self.ipc.relPath(obj.path)
+        if obj.size >= PARALLELSIZE and threads > 1:
+            self.ipc.session.data_objects.get(obj.path, localPath, num_threads = threads,
+                **{kw.FORCE_FLAG_KW: ''})
+        else:
+            with obj.open('r') as src, open(localPath, 'wb') as dst:
+                shutil.copyfileobj(src, dst, bufferSize)
+
+        return obj
+
+    def dataStreams(self):
+        '''
+        Lists the data files in the iRODS collection tree as (name, size, opener, checksum)
+        tuples, name is the path relative to the collection.
+        opener() opens an iRODS read stream, which can be passed as upload body to the
+        repository without staging the data locally.
+        '''
+        for obj in self.ipc.members():
+            yield self.ipc.relPath(obj.path), obj.size, functools.partial(obj.open, 'r'), obj.checksum
+
+    def uploadToRepo(self, data=True, stream=False):
+        '''
+        Patches the draft with the metadata, tickets and PIDs and uploads the data.
+        stream - pipe the iRODS data directly into the repository instead of making
+                 a local copy first (only if the repository supports it).
+        '''
 
         message = []
         #message.extend(self.draft.create(self.ipc.md['TITLE']))
+        message.extend(self.patchMetadata())
+        if data:
+            message.extend(self.uploadData(stream))
+
+        return message
+
+    def patchMetadata(self):
+        '''
+        Patches the draft with the metadata, tickets and PIDs.
+        '''
+        message = []
         if self.ipc.http != '':
             message.extend(self.draft.patchGeneral(self.ipc.md, collPath = self.ipc.http + self.ipc.coll.path))
         else:
@@ -87,11 +212,43 @@ class irodsRepositoryClient():
                 message.extend(self.draft.patchPIDs(self.pids))
             except:
                 message.extend(self.draft.patchRefs(self.pids))
-        if data:
-            folder = self.localCopyData()
-            message.extend(self.draft.uploadData(folder))        
+        if hasattr(self.draft, 'commit'):
+            message.extend(self.draft.commit())
 
         return message
+
+    def uploadData(self, stream=False):
+        '''
+        Uploads the data of the collection to the draft.
+        Files which are already in the draft are skipped by the repository clients,
+        so an interrupted upload can be resumed.
+        stream - pipe the iRODS data directly into the repository instead of making
+                 a local copy first (only if the repository supports it).
+        '''
+        if stream and hasattr(self.draft, 'uploadStreams'):
+            return self.draft.uploadStreams(self.dataStreams())
+        folder = self.localCopyData()
+        if self.draft.repoName == 'B2SHARE':
+            return self.draft.uploadData(folder, checksums = self.ipc.checksums())
+        if self.draft.repoName == 'Dataverse':
+            return self.draft.uploadData(folder, descriptions = self.fileDescriptions())
+        return self.draft.uploadData(folder)
+
+    def fileDescriptions(self):
+        '''
+        Describes each data object by its PID and iRODS ticket.
+        Returns a dictionary path relative to the collection --> description
+        '''
+        descriptions = {}
+        for refs, label in [(self.pids, 'PID: hdl.handle.net/'), (self.tickets, 'iRODS ticket: ')]:
+            for path, ref in refs.items():
+                # the collection itself is listed by its path or name
+                if path in [self.ipc.coll.path, self.ipc.coll.name]:
+                    continue
+                if path.startswith(self.ipc.coll.path + '/'):
+                    path = self.ipc.relPath(path)
+                descriptions.setdefault(path, []).append(label + ref)
+        return dict((path, ', '.join(descriptions[path])) for path in descriptions)
                          
     def publishDraft(self):
         '''
@@ -109,10 +266,22 @@ class irodsRepositoryClient():
             doi = self.draft.getDOI() 
         elif self.draft.repoName == 'CKAN':
             doi = self.draft.ckanID
+        if doi is None:
+            return [self.draft.repoName + ' PUBLISH ERROR: No DOI received for ' +
+                publicUrl(self.draft.draftUrl)]
+
+        return self.recordDOI(doi)
+
+    def recordDOI(self, doi):
+        '''
+        Adds the DOI and URL of the published draft to the collection in iRODS.
+        '''
+        message = []
         message.append(self.ipc.mdUpdate(self.draft.repoName+'/DOI', doi))
-        message.append(self.ipc.mdUpdate(self.draft.repoName+'/URL', self.draft.draftUrl))
-                           
-        return message                   
+        message.append(self.ipc.mdUpdate(self.draft.repoName+'/URL', publicUrl(self.draft.draftUrl)))
+        self.ipc.flush()
+
+        return message
 
     def createReport(self, content, owners=[]):
         '''
@@ -0,0 +1,148 @@
+from __future__ import absolute_import
+
+import json
+import time
+
+import httpretty
+import requests
+
+import b2shareDraft
+from b2shareDraft import b2sharePublication
+
+API = 'http://b2share.example.com/api/'
+RECORD = API + 'records/abc'
+DRAFT = RECORD + '/draft'
+
+
+class FailingSession(object):
+    def get(self, *args, **kwargs):
+        raise requests.ConnectionError('connection refused')
+
+
+class TestPoll(object):
+
+    def setup_method(self, method):
+        self.draft = b2shareDraft.b2shareDraft('token', API, 'community',
+                                               session=requests.Session())
+        self.draft.attach(DRAFT)
+
+    @httpretty.activate
+    def test_doi(self):
+        httpretty.register_uri(httpretty.GET, RECORD,
+                               body=json.dumps({'metadata': {'DOI': '10.1234/abc'}}))
+        publication = b2sharePublication(self.draft, interval=0)
+
+        assert publication.poll()
+        assert publication.doi == '10.1234/abc'
+        assert publication.error is None
+        assert httpretty.last_request().querystring['access_token'] == ['token']
+
+    @httpretty.activate
+    def test_backoff(self):
+        httpretty.register_uri(httpretty.GET, RECORD,
+                               body=json.dumps({'metadata': {}}))
+        publication = b2sharePublication(self.draft, timeout=100, interval=1)
+        publication.nextPoll = 0
+
+        assert not publication.poll()
+        assert publication.interval == 2
+        assert publication.nextPoll <= time.time() + 2
+        requestCount = len(httpretty.HTTPretty.latest_requests)
+
+        # The next poll is not due yet, the record is not requested again
+        assert not publication.poll()
+        assert len(httpretty.HTTPretty.latest_requests) == requestCount
+
+    @httpretty.activate
+    def test_poll_capped_at_deadline(self):
+        httpretty.register_uri(httpretty.GET, RECORD,
+                               body=json.dumps({'metadata': {}}))
+        publication = b2sharePublication(self.draft, timeout=3, interval=2)
+        publication.nextPoll = 0
+
+        assert not publication.poll()
+        assert publication.nextPoll == publication.deadline
+
+    @httpretty.activate
+    def test_deadline(self):
+        httpretty.register_uri(httpretty.GET, RECORD, status=404)
+        publication = b2sharePublication(self.draft, timeout=0, interval=0)
+
+        assert publication.poll()
+        assert publication.doi is None
+        assert 'PUBLISH ERROR' in publication.error
+        assert '404' in publication.error
+
+    @httpretty.activate
+    def test_invalid_json(self):
+        httpretty.register_uri(httpretty.GET, RECORD, body='<html></html>')
+        publication = b2sharePublication(self.draft, timeout=100, interval=0)
+
+        assert not publication.poll()
+        assert publication.error is None
+
+    def test_connection_error(self):
+        self.draft.session = FailingSession()
+        publication = b2sharePublication(self.draft, timeout=100, interval=0)
+
+        # A failed request means 'no DOI yet'
+        assert not publication.poll()
+        assert publication.error is None
+
+        publication.deadline = 0
+        publication.nextPoll = 0
+        assert publication.poll()
+        assert 'ConnectionError' in publication.error
+
+    @httpretty.activate
+    def test_wait_all(self):
+        httpretty.register_uri(httpretty.GET, RECORD,
+                               body=json.dumps({'metadata': {'DOI': '10.1234/abc'}}))
+        publications = [b2sharePublication(self.draft, interval=0),
+                        b2sharePublication(self.draft, error='failed')]
+
+        b2shareDraft.waitAll(publications)
+        assert publications[0].doi == '10.1234/abc'
+        assert publications[1].doi is None
+
+
+class TestCommit(object):
+
+    def setup_method(self, method):
+        self.draft = b2shareDraft.b2shareDraft('token', API, 'community',
+                                               session=requests.Session())
+        self.draft.attach(DRAFT)
+        self.patch = [{'op': 'add', 'path': '/creators', 'value': []},
+                      {'op': 'add', 'path': '/keywords', 'value': []}]
+
+    def test_nothing_staged(self):
+        assert self.draft.commit() == []
+
+    @httpretty.activate
+    def test_one_request(self):
+        httpretty.register_uri(httpretty.PATCH, DRAFT, body='{}')
+        self.draft.patch = list(self.patch)
+
+        assert self.draft.commit() == []
+        assert self.draft.patch == []
+        assert len(httpretty.HTTPretty.latest_requests) == 1
+        assert json.loads(httpretty.last_request().body) == self.patch
+
+    @httpretty.activate
+    def test_chunked_fallback(self):
+        def respond(request, uri, headers):
+            operations = json.loads(request.body)
+            if len(operations) > 1 or operations[0]['path'] == '/keywords':
+                return 400, headers, '{}'
+            return 200, headers, '{}'
+        httpretty.register_uri(httpretty.PATCH, DRAFT, body=respond)
+        self.draft.patch = list(self.patch)
+
+        errors = self.draft.commit()
+
+        # The complete patch and one request per operation
+        assert len(httpretty.HTTPretty.latest_requests) == 3
+        assert len(errors) == 1
+        assert '/keywords' in errors[0]
+        # Rejected operations stay staged for the next commit
+        assert self.draft.patch == [self.patch[1]]
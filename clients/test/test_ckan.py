@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+import json
+
+import httpretty
+import pytest
+
+import ckanClient
+from ckanClient import ckanClient as Client
+
+API = 'ckan.example.com/api/3'
+ACTION = 'http://' + API + '/action/'
+
+
+def respondWith(*responses):
+    '''
+    Returns an httpretty callback which answers with the (status, body) responses in turn.
+    '''
+    responses = list(responses)
+
+    def respond(request, uri, headers):
+        status, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        return status, headers, json.dumps(body)
+    return respond
+
+
+class TestCall(object):
+
+    def setup_method(self, method):
+        self.client = Client(API, 'token', retries=2, backoff=0)
+
+    @httpretty.activate
+    def test_result(self):
+        httpretty.register_uri(httpretty.POST, ACTION + 'package_show',
+                               body=json.dumps({'success': True, 'result': {'name': 'data'}}))
+
+        assert self.client.call('package_show', {'id': 'data'}) == {'name': 'data'}
+        request = httpretty.last_request()
+        assert request.headers['Authorization'] == 'token'
+        assert json.loads(request.body) == {'id': 'data'}
+
+    @httpretty.activate
+    def test_error_classes(self):
+        errors = [(403, ckanClient.ckanNotAuthorized), (404, ckanClient.ckanNotFound),
+                  (409, ckanClient.ckanValidationError), (400, ckanClient.ckanError)]
+        for status, error in errors:
+            httpretty.register_uri(httpretty.POST, ACTION + 'package_show', body=respondWith(
+                (status, {'success': False, 'error': {'message': 'failed'}})))
+            requestCount = len(httpretty.HTTPretty.latest_requests)
+
+            with pytest.raises(error) as raised:
+                self.client.call('package_show', {'id': 'data'})
+            assert raised.value.status == status
+            assert raised.value.error == {'message': 'failed'}
+            # Client errors are not retried
+            assert len(httpretty.HTTPretty.latest_requests) == requestCount + 1
+
+    @httpretty.activate
+    def test_no_success(self):
+        httpretty.register_uri(httpretty.POST, ACTION + 'package_show',
+                               body=json.dumps({'success': False}))
+
+        with pytest.raises(ckanClient.ckanError):
+            self.client.call('package_show')
+
+    @httpretty.activate
+    def test_invalid_json(self):
+        httpretty.register_uri(httpretty.POST, ACTION + 'package_show',
+                               status=404, body='<html></html>')
+
+        with pytest.raises(ckanClient.ckanNotFound) as raised:
+            self.client.call('package_show')
+        assert raised.value.error == {}
+
+    @httpretty.activate
+    def test_retry_server_error(self):
+        httpretty.register_uri(httpretty.POST, ACTION + 'package_show', body=respondWith(
+            (502, {}), (200, {'success': True, 'result': 'ok'})))
+
+        assert self.client.call('package_show') == 'ok'
+        assert len(httpretty.HTTPretty.latest_requests) == 2
+
+    @httpretty.activate
+    def test_retries_exhausted(self):
+        httpretty.register_uri(httpretty.POST, ACTION + 'package_show', body=respondWith(
+            (503, {})))
+
+        with pytest.raises(ckanClient.ckanServerError) as raised:
+            self.client.call('package_show')
+        assert raised.value.status == 503
+        assert len(httpretty.HTTPretty.latest_requests) == 3
+
+    @httpretty.activate
+    def test_create_not_retried(self):
+        httpretty.register_uri(httpretty.POST, ACTION + 'package_create', body=respondWith(
+            (500, {})))
+
+        with pytest.raises(ckanClient.ckanServerError):
+            self.client.call('package_create', {'name': 'data'})
+        assert len(httpretty.HTTPretty.latest_requests) == 1
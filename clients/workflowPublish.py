@@ -84,7 +84,7 @@ if out != None:
 
 print GREEN + 'Patch with metadata and data' + DEFAULT
 message.extend(['Draft URL', publishclient.draft.draftUrl, ''])
-message.extend(publishclient.uploadToRepo(data = publishclient.ipc.size()/1000. < maxDataSize))
+message.extend(publishclient.uploadToRepo(data = publishclient.ipc.size() < maxDataSize * 1000**2))
 if any(item.startswith(publishclient.draft.repoName + ' PUBLISH ERROR') for item in message):
     print 'Create report: ' + publishclient.createReport(message, owners)
     print RED + 'Metadata/data upload failed'
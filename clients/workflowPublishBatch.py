@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+@licence: Apache 2.0
+@Copyright (c) 2018, Christine Staiger (SURFsara)
+@author: Christine Staiger
+"""
+
+from irodsPublishCollection import irodsPublishCollection
+from b2shareDraft import b2shareDraft, waitAll
+from dataverseDraft import dataverseDraft
+from ckanDraft import ckanDraft, refreshKnownNames
+from irodsRepositoryClient import irodsRepositoryClient
+from irodsPublishWorkflow import irodsPublishWorkflow
+from httpSession import publicUrl
+
+from irods.session import iRODSSession
+from irods.models import Collection, CollectionMeta
+from irods.column import Like
+
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import threading
+import datetime
+import json
+import sys
+
+RED     = "\033[31m"
+GREEN   = "\033[92m"
+BLUE    = "\033[34m"
+DEFAULT = "\033[0m"
+
+class publishBatch():
+    '''
+    Non-interactive publication of many iRODS collections.
+    Collections are published concurrently, the number of concurrent publications per
+    repository is limited by the 'concurrency' of the repository in the parameters.
+    A collection is only handed to the pool when its repository has a free slot, so
+    workers never wait for a busy repository while others are idle.
+    B2SHARE drafts are submitted without waiting for the DOI, the DOIs of all submitted
+    drafts are collected at the end of the run.
+    '''
+
+    def __init__(self, parameters):
+        '''
+        parameters - dictionary, see batch_parameters_template.json
+        '''
+        if parameters.get('irodsEnvFile', '') == '':
+            sys.exit('Batch publishing requires an irods environment file.')
+        self.parameters = parameters
+        self.repositories = parameters['repositories']
+        self.limits = dict((repo, self.repositories[repo].get('concurrency', 1))
+            for repo in self.repositories)
+
+    def collections(self):
+        '''
+        Lists (collection path, repository name) of all collections to publish:
+        the explicitly listed collections and the collections found by the query.
+        '''
+        jobs = [(item['path'], item['repository']) for item in self.parameters.get('collections', [])]
+        query = self.parameters.get('query')
+        if query:
+            session = iRODSSession(irods_env_file=self.parameters['irodsEnvFile'])
+            try:
+                results = session.query(Collection.name, CollectionMeta.value).filter(
+                    CollectionMeta.name == query['key']).filter(
+                    Like(Collection.name, query['root'] + '/%'))
+                #LIKE treats _ and % in the root as wildcards
+                jobs.extend([(row[Collection.name], row[CollectionMeta.value]) for row in results
+                    if row[CollectionMeta.value] in self.repositories and
+                    row[Collection.name].startswith(query['root'] + '/')])
+            finally:
+                session.cleanup()
+
+        return sorted(set(jobs))
+
+    def draft(self, repoName):
+        repo = self.repositories[repoName]
+        if repoName == 'B2SHARE':
+            return b2shareDraft(repo['apiToken'], repo['apiUrl'], repo['community'])
+        elif repoName == 'Dataverse':
+            return dataverseDraft(repo['apiToken'], repo['apiUrl'], repo['community'])
+        elif repoName == 'CKAN':
+            return ckanDraft(repo['apiToken'], repo['apiUrl'], repo['community'],
+                ckanGroup = repo.get('group', ''))
+        raise ValueError('Unknown repository: ' + repoName)
+
+    def publish(self, job):
+        '''
+        Publishes one collection, returns a summary dictionary and the pending publication.
+        B2SHARE drafts are only submitted, the pending publication is then a tuple
+        (workflow, message, b2sharePublication) to be completed by finish(), else None.
+        '''
+        path, repoName = job
+        summary = {'collection': path, 'repository': repoName, 'status': 'failed',
+                   'stage': '', 'url': '', 'report': ''}
+        pending = None
+        ipc = None
+        try:
+            ipc = irodsPublishCollection(self.parameters['irodsEnvFile'], path,
+                httpEndpoint = self.parameters.get('http', ''),
+                workers = self.parameters.get('irodsWorkers', 4))
+            publishclient = irodsRepositoryClient(ipc, self.draft(repoName))
+            workflow = irodsPublishWorkflow(publishclient,
+                journal = self.parameters.get('journal', ''),
+                maxDataSize = self.parameters.get('maxDataSize', 2000),
+                stream = self.parameters.get('stream', False))
+            if repoName == 'B2SHARE' and 'publish' not in workflow.completed():
+                message = workflow.run(until = 'data')
+                if workflow.failed is None:
+                    pending = (workflow, message, workflow.publishAsync())
+            else:
+                message = workflow.run()
+            if pending is None:
+                self.summarise(summary, workflow, message)
+        except Exception as e:
+            summary['stage'] = repr(e)
+        finally:
+            #the session reconnects if a pending publication needs iRODS again
+            if ipc is not None:
+                ipc.session.cleanup()
+
+        return summary, pending
+
+    def finish(self, summary, pending):
+        '''
+        Records the DOI of a submitted B2SHARE draft, returns the completed summary.
+        '''
+        workflow, message, publication = pending
+        try:
+            self.summarise(summary, workflow, workflow.completePublish(publication, message))
+        except Exception as e:
+            summary['stage'] = repr(e)
+        finally:
+            workflow.client.ipc.session.cleanup()
+
+        return summary
+
+    def summarise(self, summary, workflow, message):
+        summary['report'] = workflow.client.createReport(message, workflow.owners)
+        summary['url'] = publicUrl(workflow.client.draft.draftUrl)
+        if workflow.failed is None:
+            summary['status'] = 'published'
+        else:
+            summary['stage'] = workflow.failed
+        return summary
+
+    def run(self):
+        '''
+        Publishes all collections on a pool of 'workers' threads.
+        Returns the list of summaries.
+        '''
+        jobs = self.collections()
+        ckan = self.repositories.get('CKAN', {})
+        if ckan.get('preloadNames', False) and any(repoName == 'CKAN' for path, repoName in jobs):
+            refreshKnownNames(self.draft('CKAN').client)
+        queued = dict((repoName, deque()) for repoName in self.repositories)
+        summaries = []
+        for path, repoName in jobs:
+            if repoName not in queued:
+                summaries.append({'collection': path, 'repository': repoName, 'status': 'failed',
+                    'stage': 'Unknown repository: ' + str(repoName), 'url': '', 'report': ''})
+                printSummary(summaries[-1])
+                continue
+            queued[repoName].append((path, repoName))
+        active = dict((repoName, 0) for repoName in self.repositories)
+        finished = []
+        condition = threading.Condition()
+
+        def done(result):
+            with condition:
+                active[result[0]['repository']] -= 1
+                finished.append(result)
+                condition.notify()
+
+        pool = ThreadPool(self.parameters.get('workers', 4))
+        try:
+            submitted = []
+            with condition:
+                while len(summaries) + len(submitted) < len(jobs):
+                    #submit only jobs whose repository has a free slot
+                    for repoName in queued:
+                        while queued[repoName] and active[repoName] < self.limits[repoName]:
+                            active[repoName] += 1
+                            pool.apply_async(self.publish, (queued[repoName].popleft(),),
+                                callback = done)
+                    while not finished:
+                        condition.wait()
+                    while finished:
+                        summary, pending = finished.pop(0)
+                        if pending is not None:
+                            print BLUE + 'submitted' + DEFAULT, summary['repository'], summary['collection']
+                            submitted.append((summary, pending))
+                            continue
+                        printSummary(summary)
+                        summaries.append(summary)
+        finally:
+            pool.close()
+            pool.join()
+
+        #one thread polls all submitted B2SHARE drafts until their DOIs are minted
+        publications = [pending[2] for summary, pending in submitted]
+        try:
+            waitAll(publications)
+        except Exception as e:
+            for publication in publications:
+                if not publication.done():
+                    publication.error = 'B2SHARE PUBLISH ERROR: ' + repr(e)
+        for summary, pending in submitted:
+            summaries.append(self.finish(summary, pending))
+            printSummary(summary)
+
+        return summaries
+
+def printSummary(summary):
+    color = GREEN if summary['status'] == 'published' else RED
+    print color + summary['status'] + DEFAULT, summary['repository'], summary['collection']
+
+def report(summaries):
+    '''
+    Formats the summaries of a batch run.
+    '''
+    lines = ['Batch publication ' + str(datetime.datetime.now()), '']
+    for status in ['published', 'failed']:
+        selection = [s for s in summaries if s['status'] == status]
+        lines.append(status.upper() + ': ' + str(len(selection)))
+        for s in selection:
+            lines.append('  ' + ' '.join([s['repository'], s['collection'], s['url'], s['stage']]))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('Usage: python workflowPublishBatch.py <batch parameters file>')
+    parameters = json.load(open(sys.argv[1]))
+    summaries = publishBatch(parameters).run()
+    print
+    print report(summaries)
+    if parameters.get('summary', '') != '':
+        with open(parameters['summary'], 'w') as f:
+            json.dump(summaries, f, indent=1)
@@ -109,7 +109,7 @@ message.extend(['Draft URL', publishclient.draft.draftUrl, ''])
 if publishclient.draft.repoName == 'CKAN':
     message.extend(publishclient.uploadToRepo(data = False))
 else:
-    message.extend(publishclient.uploadToRepo(data = publishclient.ipc.size()/1000. < maxDataSize))
+    message.extend(publishclient.uploadToRepo(data = publishclient.ipc.size() < maxDataSize * 1000**2))
 if any(item.startswith(publishclient.draft.repoName + ' PUBLISH ERROR') for item in message):
     print 'Create report: ' + publishclient.createReport(message, owners)
     print RED + 'Metadata/data upload failed'
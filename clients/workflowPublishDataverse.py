@@ -96,10 +96,12 @@ message.extend(draft.patchGeneral(ipc.md))
 message.extend(draft.patchRefs(pids))
 # Patch with tickets
 message.extend(draft.patchRefs(tickets, "iRODS: "))
+# Write the staged patches
+message.extend(draft.commit())
 
 # Upload data if data is small
 folder = /tmp/imageanalysis
-if ipc.size()/1000. < maxDataSize:
+if ipc.size() < maxDataSize * 1000**2:
     #download data from iRODS to local folder
     #TODO
     #folder = irc.localCopyData()
@@ -97,9 +97,11 @@ message.extend(draft.patchGeneral(ipc.md))
 message.extend(draft.patchPIDs(pids))
 # Patch with tickets
 message.extend(draft.patchTickets(tickets))
+# Write the staged patches
+message.extend(draft.commit())
 
 # Upload data if data is small
-if ipc.size()/1000. < maxDataSize:
+if ipc.size() < maxDataSize * 1000**2:
     #download data from iRODS to local folder
     #TODO
     #folder = irc.localCopyData()
@@ -114,6 +116,7 @@ doi = draft.publish()
 message.extend(['', 'Data published under DOI', doi])
 message.append(ipc.mdUpdate(draft.repoName+"/DOI", doi))
 message.append(ipc.mdUpdate(draft.repoName+"ID", draft.draftId))
+ipc.flush()
 
 # Create final report
 